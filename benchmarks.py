@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import resource
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# ==============================================================
+# CONFIGURATION
+# ==============================================================
+WORK_DIR = "bench_work"                  # synthetic data + stage outputs (wiped at the start of a run)
+RESULTS_FILE = "benchmark_results.jsonl"  # one JSON line per run, compared against the previous comparable run
+OHR_SIZE = (4096, 8192)     # synthetic OHRC strip (width, height) -> 8 x 16 = 128 patches
+TIF_SIZE = (2048, 2048)     # synthetic TMC/DTM GeoTIFFs -> 16 patches each
+COORD_STEP = 256            # coords.csv control-point spacing in pixels
+INTERP_POINTS = 20000       # pixel positions geolocated in the interpolate_coords stage
+KMEANS_K = 20               # clusters in the feature + KMeans stage
+PREDICT_IMAGES = 32         # PNG patches run through the model
+MODEL_PATH = None           # trained .pt to benchmark; None = yolov8n.yaml with random weights (offline)
+IMGSZ = 640
+KEEP_WORK_DIR = False
+
+# Every stage runs in a fresh spawned process. ru_maxrss would still report the
+# parent's peak there (it survives fork+exec), so the stage's peak is read from
+# /proc/self/status VmHWM after resetting it through /proc/self/clear_refs once
+# the imports are done. The RSS after imports is recorded too, since torch alone
+# is a few hundred MB. Worker processes a stage starts are not included.
+
+
+# ==============================================================
+# SYNTHETIC DATA
+# ==============================================================
+PDS4_META = """<?xml version="1.0" encoding="UTF-8"?>
+<Product_Observational xmlns="http://pds.nasa.gov/pds4/pds/v1">
+  <File_Area_Observational>
+    <Array_2D_Image>
+      <Axis_Array><axis_name>Line</axis_name><elements>{height}</elements></Axis_Array>
+      <Axis_Array><axis_name>Sample</axis_name><elements>{width}</elements></Axis_Array>
+    </Array_2D_Image>
+  </File_Area_Observational>
+</Product_Observational>
+"""
+
+
+def terrain(height, width, seed):
+    """Smooth random relief with some bright boulders and dark crater floors, as uint8."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.normal(size=(height // 64 + 2, width // 64 + 2))
+    rows = np.linspace(0, coarse.shape[0] - 1, height)
+    cols = np.linspace(0, coarse.shape[1] - 1, width)
+    base = np.array([np.interp(cols, np.arange(coarse.shape[1]), line) for line in coarse])
+    base = np.array([np.interp(rows, np.arange(coarse.shape[0]), col) for col in base.T]).T
+    img = 110 + 25 * base + rng.normal(0, 8, size=(height, width))
+    for _ in range(height * width // 200_000):
+        y, x, r = rng.integers(0, height), rng.integers(0, width), rng.integers(3, 40)
+        img[max(0, y - r):y + r, max(0, x - r):x + r] += rng.choice([-60, 70])
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def make_ohrc(folder, width, height, seed=0):
+    os.makedirs(folder, exist_ok=True)
+    terrain(height, width, seed).tofile(os.path.join(folder, "image.img"))
+    with open(os.path.join(folder, "meta.xml"), "w", encoding="utf-8") as f:
+        f.write(PDS4_META.format(width=width, height=height))
+    with open(os.path.join(folder, "coords.csv"), "w", encoding="utf-8") as f:
+        f.write("Pixel,Scan,Longitude,Lattitude\n")
+        for y in range(0, height + 1, COORD_STEP):
+            for x in range(0, width + 1, COORD_STEP):
+                f.write(f"{x},{y},{30 + x * 1e-5 + y * 2e-6:.8f},{-70 + y * 1e-5 - x * 1e-6:.8f}\n")
+    # only the columns load_spm / load_oat read carry values
+    with open(os.path.join(folder, "sun.spm"), "w", encoding="utf-8") as f:
+        f.write(" ".join(["0"] * 12 + ["121.4", "12.7"]) + "\n")
+    with open(os.path.join(folder, "orbit.oat"), "w", encoding="utf-8") as f:
+        f.write(" ".join(["0"] * 32 + ["0.12", "-0.05", "0.31"]) + "\n")
+
+
+def make_tif(folder, width, height, dtype, seed):
+    import rasterio
+    from rasterio.transform import from_origin
+
+    os.makedirs(folder, exist_ok=True)
+    data = terrain(height, width, seed).astype(dtype)
+    if dtype == np.float32:
+        data = data * 4.0 - 1500.0      # DTM heights in metres
+    profile = dict(driver="GTiff", width=width, height=height, count=1, dtype=data.dtype.name,
+                   transform=from_origin(30.0, -69.0, 5e-5, 5e-5), tiled=True, blockxsize=256, blockysize=256)
+    with rasterio.open(os.path.join(folder, "image.tif"), "w", **profile) as dst:
+        dst.write(data, 1)
+
+
+def build_dataset(root):
+    make_ohrc(os.path.join(root, "ohrc", "ohr_000"), *OHR_SIZE)
+    make_tif(os.path.join(root, "tmc", "tmc_000"), *TIF_SIZE, np.uint8, seed=1)
+    make_tif(os.path.join(root, "dtm", "dtm_000"), *TIF_SIZE, np.float32, seed=2)
+    return {"bytes": sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(root) for f in fs)}
+
+
+# ==============================================================
+# STAGES (each returns how many items it processed)
+# ==============================================================
+def stage_process_folder(work):
+    import generate_patches as gp
+    gp.OUTPUT_DIR = os.path.join(work, "patches")
+    os.makedirs(gp.OUTPUT_DIR, exist_ok=True)
+    data = os.path.join(work, "data")
+    return sum(gp.process_folder(os.path.join(data, kind, name), name) or 0
+               for kind, name in (("ohrc", "ohr_000"), ("tmc", "tmc_000"), ("dtm", "dtm_000")))
+
+
+def stage_interpolate_coords(work):
+    from generate_patches import load_csv_coords, interpolate_coords
+    coords_map = load_csv_coords(os.path.join(work, "data", "ohrc", "ohr_000"))
+    rng = np.random.default_rng(0)
+    xs = rng.integers(0, OHR_SIZE[0], INTERP_POINTS)
+    ys = rng.integers(0, OHR_SIZE[1], INTERP_POINTS)
+    for x, y in zip(xs, ys):
+        interpolate_coords(coords_map, int(x), int(y))
+    return INTERP_POINTS
+
+
+def stage_geogrid_lookup(work):
+    from generate_patches import load_csv_coords
+    from geolocation import GeoGrid
+    geo = GeoGrid.from_coords_map(load_csv_coords(os.path.join(work, "data", "ohrc", "ohr_000")))
+    rng = np.random.default_rng(0)
+    geo.lookup(rng.integers(0, OHR_SIZE[0], INTERP_POINTS), rng.integers(0, OHR_SIZE[1], INTERP_POINTS))
+    return INTERP_POINTS
+
+
+def stage_img_to_png(work):
+    import ohrc_img_to_png
+    ohrc_img_to_png.SKIP_EXISTING = False
+    out_dir = os.path.join(work, "ohrc_png")
+    ohrc_img_to_png.convert_tree(os.path.join(work, "patches", "ohr_000"), os.path.join(out_dir, "ohr_000"))
+    return sum(f.endswith(".png") for _, _, fs in os.walk(out_dir) for f in fs)
+
+
+def png_paths(work, limit=None):
+    folder = os.path.join(work, "ohrc_png", "ohr_000")
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith(".png")][:limit]
+
+
+def stage_features_kmeans(work):
+    """One image at a time through extract_visual_features, scaled as process_ohrc_folder does."""
+    from sklearn.preprocessing import MinMaxScaler
+    import patches_for_annotation as pfa
+    paths = png_paths(work)
+    X = np.array([pfa.extract_visual_features(path) for path in paths])
+    pfa.select_kmeans(MinMaxScaler().fit_transform(X), min(KMEANS_K, len(paths)))
+    return len(paths)
+
+
+def stage_features_kmeans_batch(work):
+    """The same selection with features from the chunked process-pool path."""
+    from sklearn.preprocessing import MinMaxScaler
+    import patches_for_annotation as pfa
+    paths = png_paths(work)
+    X = pfa.extract_visual_features_batch(paths)
+    pfa.select_kmeans(MinMaxScaler().fit_transform(X), min(KMEANS_K, len(paths)))
+    return len(paths)
+
+
+def stage_predict_cpu(work):
+    from ultralytics import YOLO
+    model = YOLO(MODEL_PATH or "yolov8n.yaml")
+    paths = png_paths(work, PREDICT_IMAGES)
+    model.predict(paths[:1], imgsz=IMGSZ, device='cpu', verbose=False)        # warm-up
+    for path in paths:
+        model.predict(path, imgsz=IMGSZ, device='cpu', verbose=False)
+    return len(paths)
+
+
+# (name, stage, unit, modules imported before the clock starts)
+STAGES = [
+    ("process_folder", stage_process_folder, "patches", ["generate_patches"]),
+    ("interpolate_coords", stage_interpolate_coords, "points", ["generate_patches"]),
+    ("geogrid_lookup", stage_geogrid_lookup, "points", ["generate_patches"]),
+    ("img_to_png", stage_img_to_png, "patches", ["ohrc_img_to_png"]),
+    ("features_kmeans", stage_features_kmeans, "patches", ["patches_for_annotation", "sklearn.preprocessing"]),
+    ("features_kmeans_batch", stage_features_kmeans_batch, "patches", ["patches_for_annotation", "sklearn.preprocessing"]),
+    ("predict_cpu", stage_predict_cpu, "images", ["ultralytics"]),
+]
+
+
+# ==============================================================
+# RUNNER
+# ==============================================================
+def proc_status_mb(field):
+    """VmRSS / VmHWM of this process in MB from /proc (None where there is no /proc)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset VmHWM to the current RSS (Linux 4.0+)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    peak = proc_status_mb("VmHWM")
+    # fallback: ru_maxrss (KiB on Linux), which includes whatever the parent reached
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(fn, imports, work):
+    """Run one stage in this (fresh) process; time it and report its own peak memory."""
+    for module in imports:
+        __import__(module)
+    reset_peak_rss()
+    rss_before = proc_status_mb("VmRSS") or peak_rss_mb()
+    start = time.perf_counter()
+    items = fn(work)
+    seconds = time.perf_counter() - start
+    return {"items": items, "seconds": seconds, "peak_rss_mb": peak_rss_mb(), "import_rss_mb": rss_before}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def previous_run(config):
+    """Last recorded run with the same workload, to compare against."""
+    if not os.path.exists(RESULTS_FILE):
+        return None
+    last = None
+    with open(RESULTS_FILE, encoding="utf-8") as f:
+        for line in f:
+            run = json.loads(line)
+            if run.get("config") == config:
+                last = run
+    return last
+
+
+def main():
+    config = {"ohr_size": list(OHR_SIZE), "tif_size": list(TIF_SIZE), "interp_points": INTERP_POINTS,
+              "kmeans_k": KMEANS_K, "predict_images": PREDICT_IMAGES, "model": MODEL_PATH or "yolov8n.yaml",
+              "imgsz": IMGSZ}
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    work = os.path.abspath(WORK_DIR)
+
+    start = time.perf_counter()
+    dataset = build_dataset(os.path.join(work, "data"))
+    print(f"🧪 Synthetic dataset: {dataset['bytes'] / 1e6:.0f} MB in {time.perf_counter() - start:.1f}s")
+
+    previous = previous_run(config)
+    stages = {}
+    ctx = multiprocessing.get_context("spawn")
+    for name, fn, unit, imports in STAGES:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            result = pool.submit(run_stage, fn, imports, work).result()
+        result["unit"] = unit
+        result["per_s"] = result["items"] / result["seconds"] if result["seconds"] else None
+        stages[name] = result
+
+        line = (f"⏱ {name:22s} {result['items']:7d} {unit:8s} {result['seconds']:8.2f}s "
+                f"{result['per_s']:10.1f} {unit}/s  peak {result['peak_rss_mb']:7.0f} MB "
+                f"(+{result['peak_rss_mb'] - result['import_rss_mb']:.0f} over imports)")
+        old = (previous or {}).get("stages", {}).get(name)
+        if old and old.get("per_s"):
+            line += f"  {(result['per_s'] / old['per_s'] - 1) * 100:+.1f}% vs {previous.get('commit')}"
+        print(line)
+
+    run = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "host": socket.gethostname(),
+           "python": platform.python_version(), "cpu_count": os.cpu_count(), "config": config, "stages": stages}
+    with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+    print(f"📄 Results appended to {RESULTS_FILE}")
+
+    if not KEEP_WORK_DIR:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
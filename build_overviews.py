@@ -0,0 +1,319 @@
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from PIL import Image
+from generate_patches import open_img_bands, get_img_size_from_metadata
+from instrumentation import stage
+
+# ==============================================================
+# CONFIGURATION
+# ==============================================================
+INPUT_DIR = "D:/DL/DATA/lunasurface_data"
+OUTPUT_DIR = "D:/DL/DATA/overviews"
+FORMATS = ['ohrc', 'tmc', 'dtm']
+TILE = 256                  # tile side returned by OverviewPyramid.tile()
+MAX_LEVELS = 8              # deepest level is 2**MAX_LEVELS x smaller (or stops once it fits in one tile)
+BAND_ROWS = 1024            # source rows read per step (even, so 2x2 blocks never straddle two bands)
+PREVIEW_SIDE = 2048         # overview.png of the first level no larger than this (None = no preview)
+NUM_WORKERS = max(1, (os.cpu_count() or 2) - 1)   # folders built in parallel
+INDEX_FILE = "index.json"
+
+# -------- OVERVIEW PYRAMID --------
+# Level L is the source averaged over 2^L x 2^L blocks (level 0 is the source
+# itself and is read in place, not copied). All levels are built in one pass:
+# each band of source rows is halved into level 1, whose rows are halved into
+# level 2 and so on, with an odd leftover row carried to the next band. A trailing
+# odd row/column is dropped at each level. Levels are raw row-major files read
+# back through np.memmap, so a tile fetch only touches the pages it needs:
+#
+#   <OUTPUT_DIR>/<folder>/index.json     source, dtype, shapes, transform/nodata (TIF)
+#   <OUTPUT_DIR>/<folder>/level_1.bin    (h >> 1, w >> 1)
+#   <OUTPUT_DIR>/<folder>/level_2.bin    ...
+#
+# TIF no-data becomes NaN on every level, level 0 included; integer TIFs with a
+# nodata value are therefore stored as float.
+
+
+def downsample(rows):
+    """2x2 block mean; NaN (TIF no-data) is ignored unless the whole block is NaN."""
+    h, w = rows.shape[0] // 2 * 2, rows.shape[1] // 2 * 2
+    blocks = rows[:h, :w].reshape(h // 2, 2, w // 2, 2)
+    if np.issubdtype(rows.dtype, np.floating):
+        valid = ~np.isnan(blocks)
+        total = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+        n = valid.sum(axis=(1, 3))
+        out = np.full(total.shape, np.nan, dtype=rows.dtype)
+        np.divide(total, n, out=out, where=n > 0, casting='unsafe')
+        return out
+    return ((blocks.sum(axis=(1, 3), dtype=np.int64) + 2) // 4).astype(rows.dtype)
+
+
+class LevelWriter:
+    """Appends the rows of one level to its .bin file and hands its half-size rows to the next level."""
+
+    def __init__(self, path, below=None):
+        self.fh = open(path, "wb")
+        self.below = below
+        self.carry = None
+        self.rows = 0
+        self.width = None
+
+    def push(self, rows):
+        if self.carry is not None:
+            rows = np.vstack([self.carry, rows])
+        even = rows.shape[0] // 2 * 2
+        self.carry = rows[even:] if even < rows.shape[0] else None
+        if even == 0:
+            return
+        half = downsample(rows[:even])
+        self.fh.write(np.ascontiguousarray(half).tobytes())
+        self.rows += half.shape[0]
+        self.width = half.shape[1]
+        if self.below is not None:
+            self.below.push(half)
+
+    def close(self):
+        self.fh.close()
+        if self.below is not None:
+            self.below.close()
+
+
+def level_count(height, width):
+    levels = 0
+    while levels < MAX_LEVELS and max(height, width) >> levels > TILE and min(height, width) >> (levels + 1) > 0:
+        levels += 1
+    return levels
+
+
+def level_dtype(dtype, nodata):
+    """Pyramid dtype of a TIF: integers with a nodata value are promoted to float so it can become NaN."""
+    if nodata is None or np.issubdtype(dtype, np.floating):
+        return dtype
+    return np.result_type(dtype, np.float32)
+
+
+def mask_nodata(band, nodata):
+    """A TIF band in its level dtype with nodata pixels as NaN (what downsample() skips)."""
+    if nodata is None:
+        return band
+    band = band.astype(level_dtype(band.dtype, nodata), copy=False)
+    band[band == nodata] = np.nan
+    return band
+
+
+def source_bands(folder_path):
+    """(kind, image path, (height, width), dtype, extra index fields, band generator) for one folder."""
+    img_path = os.path.join(folder_path, "image.img")
+    if os.path.exists(img_path):
+        bands = open_img_bands(folder_path, BAND_ROWS)
+        if bands is None:
+            return None
+        width, height = get_img_size_from_metadata(folder_path)
+        return "img", img_path, (height, width), np.dtype(np.uint8), {}, (band for _, band in bands)
+
+    tif_path = os.path.join(folder_path, "image.tif")
+    if not os.path.exists(tif_path):
+        return None
+    with rasterio.open(tif_path) as src:
+        shape, dtype, nodata = (src.height, src.width), np.dtype(src.dtypes[0]), src.nodata
+        extra = {"transform": list(src.transform)[:6], "nodata": nodata}
+
+    def bands():
+        with rasterio.open(tif_path) as src:
+            for row_off in range(0, src.height, BAND_ROWS):
+                band = src.read(1, window=Window(0, row_off, src.width, min(BAND_ROWS, src.height - row_off)))
+                yield mask_nodata(band, nodata)
+
+    return "tif", tif_path, shape, level_dtype(dtype, nodata), extra, bands()
+
+
+def build_pyramid(folder_path, out_dir):
+    """Write every overview level of one folder in a single pass over its source; returns bytes read."""
+    source = source_bands(folder_path)
+    if source is None:
+        print(f"⚠️ Skipping {os.path.basename(folder_path)} (no readable image)")
+        return None
+    kind, image_path, (height, width), dtype, extra, bands = source
+    levels = level_count(height, width)
+    os.makedirs(out_dir, exist_ok=True)
+
+    writers = None
+    for level in range(levels, 0, -1):
+        writers = LevelWriter(os.path.join(out_dir, f"level_{level}.bin"), writers)
+    try:
+        for band in bands:
+            if writers is not None:
+                writers.push(np.asarray(band))
+    finally:
+        if writers is not None:
+            writers.close()
+
+    index = {"source": os.path.abspath(image_path), "kind": kind, "dtype": dtype.str, "tile": TILE,
+             "shape": [height, width], "levels": [[height >> level, width >> level] for level in range(1, levels + 1)],
+             **extra}
+    tmp_path = os.path.join(out_dir, INDEX_FILE + ".tmp")
+    with open(tmp_path, "w", encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    # the index only appears once every level is complete
+    os.replace(tmp_path, os.path.join(out_dir, INDEX_FILE))
+    return os.path.getsize(image_path)
+
+
+# ==============================================================
+# TILE ACCESS
+# ==============================================================
+class OverviewPyramid:
+    """Read tiles of any level: `pyr.tile(level, tx, ty)`; level 0 is read from the source in place.
+
+    Coarse-to-fine use: scan the small levels first, then descend with
+    children() or source_window() only where something was found.
+    """
+
+    def __init__(self, pyramid_dir):
+        with open(os.path.join(pyramid_dir, INDEX_FILE), encoding='utf-8') as f:
+            self.index = json.load(f)
+        self.dir = pyramid_dir
+        self.dtype = np.dtype(self.index["dtype"])
+        self.tile_size = self.index["tile"]
+        self.shapes = [tuple(self.index["shape"])] + [tuple(s) for s in self.index["levels"]]
+        self._maps = {}
+        self._tif = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+        self._maps = {}
+
+    @property
+    def levels(self):
+        return len(self.shapes)
+
+    def shape(self, level):
+        return self.shapes[level]
+
+    def tiles(self, level):
+        """(tiles across, tiles down) at a level; edge tiles may be smaller."""
+        h, w = self.shapes[level]
+        return -(-w // self.tile_size), -(-h // self.tile_size)
+
+    def _level(self, level):
+        if level not in self._maps:
+            if level == 0 and self.index["kind"] == "img":
+                self._maps[0] = np.memmap(self.index["source"], dtype=self.dtype, mode='r', shape=self.shapes[0])
+            else:
+                self._maps[level] = np.memmap(os.path.join(self.dir, f"level_{level}.bin"), dtype=self.dtype,
+                                              mode='r', shape=self.shapes[level])
+        return self._maps[level]
+
+    def read(self, level, x, y, width, height):
+        """Pixel window of a level, clipped to the level's extent (a zero-copy view except for TIF level 0).
+
+        A window wholly outside the level gives an empty array.
+        """
+        h, w = self.shapes[level]
+        x0, y0 = min(max(0, x), w), min(max(0, y), h)
+        x1, y1 = max(x0, min(w, x + width)), max(y0, min(h, y + height))
+        if level == 0 and self.index["kind"] == "tif":
+            if self._tif is None:
+                self._tif = rasterio.open(self.index["source"])
+            # masked like the levels built from it, so a tile looks the same at every level
+            return mask_nodata(self._tif.read(1, window=Window(x0, y0, x1 - x0, y1 - y0)), self.index.get("nodata"))
+        return self._level(level)[y0:y1, x0:x1]
+
+    def tile(self, level, tx, ty):
+        return self.read(level, tx * self.tile_size, ty * self.tile_size, self.tile_size, self.tile_size)
+
+    def children(self, level, tx, ty):
+        """Tiles of the next finer level covering the same ground."""
+        if level == 0:
+            return []
+        nx, ny = self.tiles(level - 1)
+        return [(level - 1, cx, cy) for cy in (2 * ty, 2 * ty + 1) for cx in (2 * tx, 2 * tx + 1)
+                if cx < nx and cy < ny]
+
+    def source_window(self, level, tx, ty):
+        """(x, y, width, height) in full-resolution pixels of a tile, e.g. to geolocate or tile it."""
+        scale = 2 ** level
+        h, w = self.shapes[0]
+        x, y = tx * self.tile_size * scale, ty * self.tile_size * scale
+        return x, y, min(self.tile_size * scale, w - x), min(self.tile_size * scale, h - y)
+
+    def preview(self, max_side=PREVIEW_SIDE):
+        """The finest level that fits in max_side pixels, as one array."""
+        level = next((lv for lv in range(self.levels) if max(self.shapes[lv]) <= max_side), self.levels - 1)
+        h, w = self.shapes[level]
+        return self.read(level, 0, 0, w, h)
+
+
+def save_preview(pyramid_dir):
+    with OverviewPyramid(pyramid_dir) as pyr:
+        image = np.asarray(pyr.preview(), dtype=np.float32)
+    valid = image[~np.isnan(image)]
+    lo, hi = np.percentile(valid, (2, 98)) if valid.size else (0, 1)
+    stretched = np.clip((np.nan_to_num(image, nan=lo) - lo) * (255.0 / max(hi - lo, 1e-6)), 0, 255).astype(np.uint8)
+    Image.fromarray(stretched).save(os.path.join(pyramid_dir, "overview.png"), compress_level=1)
+
+
+def run_folder(folder_path, folder_name):
+    """Build one folder's pyramid (and preview); returns (folder, levels, seconds)."""
+    start = time.perf_counter()
+    out_dir = os.path.join(OUTPUT_DIR, folder_name)
+    with stage("build_overviews.folder", folder=folder_name) as st:
+        read = build_pyramid(folder_path, out_dir)
+        if read is not None:
+            st.count(bytes=read)
+            if PREVIEW_SIDE:
+                save_preview(out_dir)
+    levels = OverviewPyramid(out_dir).levels - 1 if read is not None else 0
+    return folder_name, levels, time.perf_counter() - start
+
+
+def pending_folders():
+    """(folder_path, folder_name) of every input folder whose pyramid is missing or older than its image."""
+    jobs = []
+    for fmt in FORMATS:
+        folder_root = os.path.join(INPUT_DIR, fmt)
+        if not os.path.isdir(folder_root):
+            continue
+        for folder in sorted(os.listdir(folder_root)):
+            folder_path = os.path.join(folder_root, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            index_path = os.path.join(OUTPUT_DIR, folder, INDEX_FILE)
+            images = [os.path.join(folder_path, f) for f in ("image.img", "image.tif")
+                      if os.path.exists(os.path.join(folder_path, f))]
+            if os.path.exists(index_path) and all(os.path.getmtime(index_path) >= os.path.getmtime(i) for i in images):
+                print(f"⏩ Overviews up to date: {folder}")
+                continue
+            jobs.append((folder_path, folder))
+    return jobs
+
+
+if __name__ == "__main__":
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    jobs = pending_folders()
+
+    if NUM_WORKERS > 1 and len(jobs) > 1:
+        print(f"\n🚀 Building overviews for {len(jobs)} folders on {NUM_WORKERS} workers")
+        with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+            futures = [pool.submit(run_folder, path, name) for path, name in jobs]
+            for future in as_completed(futures):
+                name, levels, seconds = future.result()
+                print(f"✅ {name}: {levels} levels in {seconds:.1f}s")
+    else:
+        for folder_path, folder in jobs:
+            name, levels, seconds = run_folder(folder_path, folder)
+            print(f"✅ {name}: {levels} levels in {seconds:.1f}s")
+
+    print("🎉 Overview pyramids complete.")
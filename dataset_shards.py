@@ -0,0 +1,292 @@
+import os
+import re
+import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.data.utils import check_det_dataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import LOGGER, colorstr
+from ultralytics.utils.ops import segments2boxes
+from patch_store import PatchStore, PatchStoreWriter, is_store, INDEX_FILE as STORE_INDEX
+
+# ==============================================================
+# CONFIGURATION
+# ==============================================================
+DATA_YAML = r"D:/DL/DATA/moon_ohrc_detection.v2i.yolov8-obb/data.yaml"  # Roboflow export (labels + splits)
+SELECTED_DIR = "D:/DL/DATA/selected_patches"    # lossless source PNGs the export was made from
+SHARD_DIR = "D:/DL/DATA/dataset_shards"         # one patch store per split: train/, val/, test/
+IMGSZ = 640                 # long side of the stored images; must match the training imgsz
+GRAYSCALE = True            # OHRC is single-band: store one channel (3x smaller), expanded to BGR on load
+SOURCE_PNGS = True          # take pixels from SELECTED_DIR instead of the export's JPEGs when they match
+MATCH_MARGIN = 0.5          # PNG replaces its JPEG only if its preview error is < this x that of any flip/rotation
+SHARD_IMAGES = 1024         # images per shard file (1024 x 640 x 640 = 400 MB grayscale)
+BUILD_WORKERS = os.cpu_count() or 1
+BUILD_CHUNK = 32            # images decoded + resized per task
+
+# -------- PRE-DECODED TRAINING SHARDS --------
+# Each split of the Roboflow export becomes a PatchStore. Its images are already
+# resized (long side = IMGSZ, as ultralytics' load_image would) and padded into a
+# fixed IMGSZ x IMGSZ slot. The label rows sit in each image's meta as well:
+#   {"file", "source", "shape": [h0, w0], "hw": [h, w], "labels": [[cls, x1, y1, ... x4, y4], ...]}
+# ShardDataset serves these to ultralytics straight from the memory-mapped
+# shards, so an epoch costs one memcpy per image instead of a JPEG decode and a
+# resize. ShardTrainer is a DetectionTrainer that uses it for every split that
+# has been built.
+# Roboflow names exports "<patch id>_png.rf.<hash>.jpg", so the lossless PNG can
+# be found again. It is only used when its preview matches the JPEG clearly
+# better as-is than flipped or rotated by any multiple of 90 degrees, which
+# catches geometric augmentations applied during the export; ambiguous (e.g.
+# nearly flat) patches keep the JPEG.
+
+PATCH_ID = re.compile(r"^(.+?_patch_\d+)")
+
+
+# ==============================================================
+# BUILD
+# ==============================================================
+def read_label_rows(label_path):
+    if not os.path.exists(label_path):
+        return []
+    with open(label_path, encoding="utf-8") as f:
+        return [[float(v) for v in line.split()] for line in f if line.strip()]
+
+
+def index_source_pngs(root):
+    """{patch id: path} of every PNG under SELECTED_DIR."""
+    found = {}
+    if root and os.path.isdir(root):
+        for dirpath, _, files in os.walk(root):
+            for file in files:
+                if file.lower().endswith(".png"):
+                    found[os.path.splitext(file)[0]] = os.path.join(dirpath, file)
+    return found
+
+
+def preview(img):
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def same_orientation(png, img, margin=MATCH_MARGIN):
+    """True when png matches img as-is clearly better than under any flip or 90-degree rotation."""
+    a, b = preview(png), preview(img)
+    identity = np.abs(a - b).mean()
+    variants = [np.rot90(a, k) for k in (1, 2, 3)] + [a[::-1], a[:, ::-1], a.T, np.rot90(a, 2).T]
+    return all(identity < margin * np.abs(v - b).mean() for v in variants)
+
+
+def resize_long_side(img, imgsz):
+    """Long side to imgsz with ultralytics' rounding and interpolation."""
+    h0, w0 = img.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        img = cv2.resize(img, (min(math.ceil(w0 * r), imgsz), min(math.ceil(h0 * r), imgsz)),
+                         interpolation=cv2.INTER_LINEAR)
+    return img
+
+
+def prepare_image(export_path, png_path, imgsz, grayscale):
+    """(padded slot, source used, original (h, w), resized (h, w)) for one exported image."""
+    img = cv2.imread(export_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise FileNotFoundError(export_path)
+    source = export_path
+    if png_path is not None:
+        png = cv2.imread(png_path, cv2.IMREAD_COLOR)
+        if (png is not None and abs(png.shape[1] / png.shape[0] - img.shape[1] / img.shape[0]) < 0.01
+                and same_orientation(png, img)):
+            img, source = png, png_path
+    h0, w0 = img.shape[:2]
+    img = resize_long_side(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if grayscale else img, imgsz)
+    slot = np.zeros((imgsz, imgsz) if grayscale else (imgsz, imgsz, 3), dtype=np.uint8)
+    slot[:img.shape[0], :img.shape[1]] = img
+    return slot, source, (h0, w0), img.shape[:2]
+
+
+def _prepare_chunk(jobs, imgsz, grayscale):
+    return [prepare_image(export_path, png_path, imgsz, grayscale) for export_path, png_path in jobs]
+
+
+def split_images(images_dir):
+    return sorted(os.path.join(images_dir, f) for f in os.listdir(images_dir)
+                  if f.lower().endswith((".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")))
+
+
+def label_path_for(image_path):
+    # ultralytics convention: <split>/images/x.jpg -> <split>/labels/x.txt
+    images_dir, name = os.path.split(image_path)
+    return os.path.join(os.path.dirname(images_dir), "labels", os.path.splitext(name)[0] + ".txt")
+
+
+def is_current(store_dir, images_dir):
+    index_path = os.path.join(store_dir, STORE_INDEX)
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path, encoding="utf-8") as f:
+        index = json.load(f)
+    if index["shape"][:2] != [IMGSZ, IMGSZ] or (len(index["shape"]) == 2) != GRAYSCALE:
+        return False
+    labels_dir = os.path.join(os.path.dirname(images_dir), "labels")
+    newest = max((os.path.getmtime(d) for d in (images_dir, labels_dir) if os.path.isdir(d)), default=0)
+    return os.path.getmtime(index_path) >= newest
+
+
+def build_split(images_dir, store_dir, png_index):
+    images = split_images(images_dir)
+    jobs = [(path, png_index.get(m.group(1)) if SOURCE_PNGS and (m := PATCH_ID.match(os.path.basename(path)))
+             else None) for path in images]
+    chunks = [jobs[i:i + BUILD_CHUNK] for i in range(0, len(jobs), BUILD_CHUNK)]
+    from_png = 0
+    with PatchStoreWriter(store_dir, shard_patches=SHARD_IMAGES) as writer:
+        if BUILD_WORKERS > 1 and len(chunks) > 1:
+            pool = ProcessPoolExecutor(max_workers=BUILD_WORKERS)
+            results = pool.map(_prepare_chunk, chunks, [IMGSZ] * len(chunks), [GRAYSCALE] * len(chunks))
+        else:
+            pool, results = None, (_prepare_chunk(chunk, IMGSZ, GRAYSCALE) for chunk in chunks)
+        try:
+            for chunk, prepared in zip(chunks, results):
+                for (export_path, _), (slot, source, shape, hw) in zip(chunk, prepared):
+                    from_png += source != export_path
+                    writer.add(os.path.splitext(os.path.basename(export_path))[0], slot, {
+                        "file": export_path, "source": source, "shape": list(shape), "hw": list(hw),
+                        "labels": read_label_rows(label_path_for(export_path))})
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    return len(images), from_png
+
+
+def build_shards(data_yaml=None, shard_dir=None):
+    """Build (or refresh) the shards of every split in data_yaml; returns {split: store dir}."""
+    data = check_det_dataset(data_yaml or DATA_YAML)
+    shard_dir = shard_dir or SHARD_DIR
+    png_index = index_source_pngs(SELECTED_DIR) if SOURCE_PNGS else {}
+    built = {}
+    for split in ("train", "val", "test"):
+        images_dir = data.get(split)
+        if not isinstance(images_dir, str) or not os.path.isdir(images_dir):
+            continue
+        store_dir = os.path.join(shard_dir, split)
+        built[split] = store_dir
+        if is_current(store_dir, images_dir):
+            print(f"⏩ Shards up to date: {split}")
+            continue
+        start = time.perf_counter()
+        n, from_png = build_split(images_dir, store_dir, png_index)
+        print(f"✅ {split}: {n} images packed ({from_png} from source PNGs) in {time.perf_counter() - start:.1f}s")
+    return built
+
+
+# ==============================================================
+# ULTRALYTICS DATASET + TRAINER
+# ==============================================================
+def shard_dir_for(img_path, data, shard_dir=None):
+    """Store of the split whose image path in the data dict is img_path (None if not built)."""
+    for split in ("train", "val", "test"):
+        store_dir = os.path.join(shard_dir or SHARD_DIR, split)
+        if data.get(split) == img_path and is_store(store_dir):
+            return store_dir
+    return None
+
+
+class ShardDataset(YOLODataset):
+    """YOLODataset reading pre-resized images and labels from a patch store instead of image files."""
+
+    def __init__(self, *args, store_dir, **kwargs):
+        self.store_dir = store_dir
+        self._store = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def store(self):
+        # opened lazily, so dataloader workers map the shards themselves instead of pickling them
+        if self._store is None:
+            self._store = PatchStore(self.store_dir)
+        return self._store
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_store"] = None
+        return state
+
+    def get_img_files(self, img_path):
+        ids = self.store.ids()
+        # ultralytics semantics: a float (and 0 / 1) is a ratio of the split, any other int an image count
+        fraction = float(self.fraction) if self.fraction in (0, 1) else self.fraction
+        count = fraction if isinstance(fraction, int) else max(1, round(len(ids) * fraction))
+        self.ids = ids[:count]
+        return [self.store.meta(pid)["file"] for pid in self.ids]
+
+    def get_labels(self):
+        labels = []
+        for pid, im_file in zip(self.ids, self.im_files):
+            meta = self.store.meta(pid)
+            rows = meta["labels"]
+            segments = []
+            if any(len(r) > 6 for r in rows):      # OBB / polygon rows -> boxes, as ultralytics' label scan does
+                segments = [np.array(r[1:], dtype=np.float32).reshape(-1, 2) for r in rows]
+                boxes = segments2boxes(segments)
+            else:
+                boxes = np.array([r[1:5] for r in rows], dtype=np.float32).reshape(-1, 4)
+            labels.append({"im_file": im_file, "shape": tuple(meta["shape"]),
+                           "cls": np.array([r[0] for r in rows], dtype=np.float32).reshape(-1, 1),
+                           "bboxes": boxes.astype(np.float32), "segments": segments, "keypoints": None,
+                           "normalized": True, "bbox_format": "xywh"})
+        return labels
+
+    def load_image(self, i, rect_mode=True, **kwargs):
+        if self.ims[i] is not None:
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+        meta = self.store.meta(self.ids[i])
+        (h0, w0), (h, w) = meta["shape"], meta["hw"]
+        im = self.store.get(self.ids[i])[:h, :w]
+        # always a fresh array: augmentations write into it in place
+        if im.ndim == 2 and self.channels != 1:
+            im = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
+        else:
+            im = np.array(im).reshape(h, w, -1)
+        if not rect_mode and not (h == w == self.imgsz):
+            im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+            if im.ndim == 2:
+                im = im[..., None]
+
+        # Add to buffer if training with augmentations (same bookkeeping as BaseDataset)
+        if self.augment and self.cache != "ram":
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), im.shape[:2]
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+        return im, (h0, w0), im.shape[:2]
+
+
+class ShardTrainer(DetectionTrainer):
+    """DetectionTrainer that reads every split with built shards through ShardDataset."""
+
+    shard_dir = None        # the shard_dir given to build_shards (None = SHARD_DIR)
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        store_dir = shard_dir_for(img_path, self.data, self.shard_dir)
+        if store_dir is not None and PatchStore(store_dir).shape[0] != self.args.imgsz:
+            LOGGER.warning(f"{store_dir} was built for another imgsz, reading the images instead")
+            store_dir = None
+        if store_dir is None:
+            return super().build_dataset(img_path, mode, batch)
+        gs = max(int(getattr(self.model, "module", self.model).stride.max()), 32)
+        return ShardDataset(
+            img_path=img_path, store_dir=store_dir, imgsz=self.args.imgsz, batch_size=batch,
+            augment=mode == "train", hyp=self.args, rect=self.args.rect or mode == "val",
+            cache=self.args.cache or None, single_cls=self.args.single_cls or False, stride=gs,
+            pad=0.0 if mode == "train" else 0.5, prefix=colorstr(f"{mode} (shards): "), task=self.args.task,
+            classes=self.args.classes, data=self.data, fraction=self.args.fraction if mode == "train" else 1.0)
+
+
+if __name__ == "__main__":
+    stores = build_shards()
+    for split, store_dir in stores.items():
+        store = PatchStore(store_dir)
+        print(f"📦 {split}: {len(store)} images, {len(store.shards)} shard(s) in {store_dir}")
@@ -0,0 +1,281 @@
+import os
+import re
+import csv
+import json
+import math
+import time
+import sqlite3
+from collections import defaultdict
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.warp import transform as warp_transform
+from generate_patches import load_csv_coords
+from geolocation import GeoGrid
+from patch_metadata import load_folder_metas
+
+# ==============================================================
+# CONFIGURATION
+# ==============================================================
+PREDICTIONS_CSV = r"D:/DL/DATA/runs/detect/unannotated_predictions/predictions.csv"
+PATCH_DIR = "D:/DL/DATA/patches"                 # generate_patches OUTPUT_DIR (patch JSONs / metadata table)
+METADATA_DB = "patch_metadata.sqlite"            # inside PATCH_DIR; falls back to the per-patch JSONs
+OHRC_DIR = "D:/DL/DATA/lunasurface_data/ohrc"    # strip folders holding coords.csv
+TIF_DIRS = {"tmc": "D:/DL/DATA/lunasurface_data/tmc",   # TMC/DTM folders holding image.tif (for its CRS)
+            "dtm": "D:/DL/DATA/lunasurface_data/dtm"}
+LUNAR_GEOGRAPHIC = "+proj=longlat +R=1737400 +no_defs"  # lon/lat CRS for projected rasters naming no body shape
+CATALOG_DB = "D:/DL/DATA/detection_catalog.sqlite"
+XYWH_NORMALIZED = False     # True when the CSV holds 0-1 xywh instead of pixels
+PATCH_SIZE = 512            # patch side in pixels, to scale normalised boxes
+MERGE_RADIUS_M = 5.0        # same-class detections from different strips closer than this are one object
+MOON_RADIUS_M = 1737400.0
+
+# Example query printed after the build (None = skip)
+QUERY_LON, QUERY_LAT, QUERY_RADIUS_M = None, None, 2000.0
+
+SCHEMA = """
+CREATE TABLE detections (
+    id INTEGER PRIMARY KEY, image TEXT, patch_id TEXT, folder TEXT, class_id INTEGER, class_name TEXT,
+    confidence REAL, strip_x REAL, strip_y REAL, width_px REAL, height_px REAL,
+    longitude REAL, latitude REAL, duplicate_of INTEGER);
+CREATE VIRTUAL TABLE detections_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+CREATE INDEX idx_detections_class ON detections (class_name);
+"""
+
+PATCH_ID = re.compile(r"^(.+?_patch_\d+)")      # strips Roboflow's "_png.rf.<hash>" suffix too
+
+
+# ==============================================================
+# GEOREFERENCING
+# ==============================================================
+def wrap_lon(lon):
+    """Longitudes into [-180, 180) so one convention is indexed whatever coords.csv uses."""
+    return (np.asarray(lon, dtype=np.float64) + 180.0) % 360.0 - 180.0
+
+
+def source_crs(folder):
+    """CRS of a TMC/DTM folder's image.tif, or None when the image or its CRS is missing."""
+    for key, root in TIF_DIRS.items():
+        image_path = os.path.join(root, folder, "image.tif")
+        if key in folder and os.path.exists(image_path):
+            with rasterio.open(image_path) as src:
+                return src.crs
+    return None
+
+
+def geographic_crs(crs):
+    """lon/lat CRS on the same body (sphere / ellipsoid) as a projected CRS."""
+    shape = {k: v for k, v in crs.to_dict().items() if k in ("R", "a", "b", "rf", "ellps", "datum")}
+    return CRS.from_dict(proj="longlat", no_defs=True, **shape) if shape else CRS.from_string(LUNAR_GEOGRAPHIC)
+
+
+def patch_meta(folder, patch_id, metas):
+    meta = metas.get(patch_id)
+    if meta is None:
+        json_path = os.path.join(PATCH_DIR, folder, f"{patch_id}.json")
+        if os.path.exists(json_path):
+            with open(json_path, encoding='utf-8') as f:
+                meta = json.load(f)
+    return meta
+
+
+def georeference_folder(folder, rows):
+    """lon/lat centre + footprint for every prediction row of one patch folder.
+
+    OHRC patches go through the strip's coords.csv (GeoGrid); TMC/DTM patches
+    through the affine transform stored with the patch, reprojected to lon/lat
+    when the source raster is projected. Folders whose CRS is unknown are skipped.
+    """
+    metas = load_folder_metas(os.path.join(PATCH_DIR, METADATA_DB) if METADATA_DB else None, folder)
+    geo = None
+    if "ohr" in folder and os.path.isdir(os.path.join(OHRC_DIR, folder)):
+        geo = GeoGrid.from_coords_map(load_csv_coords(os.path.join(OHRC_DIR, folder)))
+
+    located, map_xy = [], []     # map_xy: rows located in a TIF's own CRS, reprojected together below
+    for row, patch_id in rows:
+        meta = patch_meta(folder, patch_id, metas)
+        if meta is None:
+            continue
+        scale = PATCH_SIZE if XYWH_NORMALIZED else 1.0
+        xc, yc = float(row["x_center"]) * scale, float(row["y_center"]) * scale
+        w, h = float(row["width"]) * scale, float(row["height"]) * scale
+        # centre + the two opposite corners, in strip pixels
+        xs = meta["pixel_x"] + np.array([xc, xc - w / 2, xc + w / 2])
+        ys = meta["pixel_y"] + np.array([yc, yc - h / 2, yc + h / 2])
+        if "transform" in meta:
+            t = Affine(*meta["transform"][:6])
+            map_xy.append(len(located))
+            lon, lat = t * (xs - meta["pixel_x"], ys - meta["pixel_y"])
+        elif geo is not None:
+            lon, lat = geo.lookup(xs, ys)
+        else:
+            continue
+        located.append([row, patch_id, xs, ys, w, h, np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)])
+
+    if map_xy:
+        crs = source_crs(folder)
+        if crs is None:
+            print(f"⚠ {folder}: CRS of the source image.tif unknown, its {len(map_xy)} detections are skipped")
+            skipped = set(map_xy)
+            located = [r for i, r in enumerate(located) if i not in skipped]
+        elif not crs.is_geographic:
+            x = np.concatenate([located[i][6] for i in map_xy])
+            y = np.concatenate([located[i][7] for i in map_xy])
+            lon, lat = warp_transform(crs, geographic_crs(crs), x, y)
+            for n, i in enumerate(map_xy):
+                located[i][6], located[i][7] = np.asarray(lon[3 * n:3 * n + 3]), np.asarray(lat[3 * n:3 * n + 3])
+
+    records = []
+    for row, patch_id, xs, ys, w, h, lon, lat in located:
+        if np.isnan(lon[0]) or np.isnan(lat[0]):
+            continue
+        records.append((row["image"], patch_id, folder, int(row["class_id"]), row["class_name"],
+                        float(row["confidence"]), xs[0], ys[0], w, h, wrap_lon(lon), lat))
+    return records
+
+
+# ==============================================================
+# CATALOG
+# ==============================================================
+def metres_to_degrees(radius_m, lat):
+    """Half-widths (dlon, dlat) in degrees of a radius around a latitude."""
+    dlat = math.degrees(radius_m / MOON_RADIUS_M)
+    cos_lat = math.cos(math.radians(min(abs(lat), 89.999)))
+    return min(180.0, dlat / cos_lat), dlat
+
+
+def surface_distance(lon1, lat1, lon2, lat2):
+    """Great-circle distance in metres on the lunar sphere (haversine, vectorised over lon2/lat2)."""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, np.asarray(lon2), np.asarray(lat2)))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * MOON_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class DetectionCatalog:
+    def __init__(self, db_path=CATALOG_DB):
+        self.conn = sqlite3.connect(db_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def rebuild(self, records):
+        """Replace the catalog with georeferenced records from georeference_folder()."""
+        self.conn.executescript("DROP TABLE IF EXISTS detections; DROP TABLE IF EXISTS detections_rtree;" + SCHEMA)
+        rows, boxes = [], []
+        for i, (image, patch_id, folder, cls, name, conf, sx, sy, w, h, lon, lat) in enumerate(records, start=1):
+            rows.append((i, image, patch_id, folder, cls, name, conf, sx, sy, w, h, lon[0], lat[0], None))
+            boxes.append((i, float(np.min(lon)), float(np.max(lon)), float(np.min(lat)), float(np.max(lat))))
+        self.conn.executemany(f"INSERT INTO detections VALUES ({', '.join('?' * 14)})", rows)
+        self.conn.executemany("INSERT INTO detections_rtree VALUES (?, ?, ?, ?, ?)", boxes)
+        self.conn.commit()
+        return len(rows)
+
+    def _window(self, lon_min, lon_max, lat_min, lat_max):
+        """Ids whose footprint intersects a lon/lat box; boxes crossing +-180 are split in two."""
+        spans = [(lon_min, lon_max)]
+        if lon_min < -180:
+            spans = [(lon_min + 360, 180), (-180, lon_max)]
+        elif lon_max > 180:
+            spans = [(lon_min, 180), (-180, lon_max - 360)]
+        ids = set()
+        for lo, hi in spans:
+            ids.update(r[0] for r in self.conn.execute(
+                "SELECT id FROM detections_rtree WHERE max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?",
+                (lo, hi, lat_min, lat_max)))
+        return ids
+
+    def _fetch(self, ids, class_name, include_duplicates):
+        if not ids:
+            return []
+        sql = (f"SELECT id, image, folder, class_name, confidence, longitude, latitude FROM detections "
+               f"WHERE id IN ({', '.join('?' * len(ids))})")
+        args = list(ids)
+        if class_name is not None:
+            sql += " AND class_name = ?"
+            args.append(class_name)
+        if not include_duplicates:
+            sql += " AND duplicate_of IS NULL"
+        return self.conn.execute(sql, args).fetchall()
+
+    def in_bbox(self, lon_min, lon_max, lat_min, lat_max, class_name=None, include_duplicates=False):
+        """Detections whose footprint intersects a lon/lat box:
+        [(id, image, folder, class_name, confidence, lon, lat)]."""
+        return self._fetch(self._window(lon_min, lon_max, lat_min, lat_max), class_name, include_duplicates)
+
+    def within(self, lon, lat, radius_m, class_name=None, include_duplicates=False):
+        """Detections whose centre lies within radius_m of (lon, lat), nearest first, with distance appended."""
+        dlon, dlat = metres_to_degrees(radius_m, lat)
+        rows = self.in_bbox(lon - dlon, lon + dlon, lat - dlat, lat + dlat, class_name, include_duplicates)
+        if not rows:
+            return []
+        dist = surface_distance(lon, lat, [r[5] for r in rows], [r[6] for r in rows])
+        return [rows[i] + (float(dist[i]),) for i in np.argsort(dist) if dist[i] <= radius_m]
+
+    def merge_duplicates(self, radius_m=MERGE_RADIUS_M):
+        """Mark same-class detections of other strips within radius_m of a stronger one as its duplicate."""
+        self.conn.execute("UPDATE detections SET duplicate_of = NULL")
+        rows = self.conn.execute(
+            "SELECT id, folder, class_name, longitude, latitude FROM detections ORDER BY confidence DESC, id").fetchall()
+        kept, duplicates = set(), []
+        for det_id, folder, name, lon, lat in rows:
+            dlon, dlat = metres_to_degrees(radius_m, lat)
+            candidates = [c for c in self._fetch(self._window(lon - dlon, lon + dlon, lat - dlat, lat + dlat), name, True)
+                          if c[0] in kept and c[2] != folder]
+            if candidates:
+                dist = surface_distance(lon, lat, [c[5] for c in candidates], [c[6] for c in candidates])
+                nearest = int(np.argmin(dist))
+                if dist[nearest] <= radius_m:
+                    duplicates.append((candidates[nearest][0], det_id))
+                    continue
+            kept.add(det_id)
+        self.conn.executemany("UPDATE detections SET duplicate_of = ? WHERE id = ?", duplicates)
+        self.conn.commit()
+        return len(duplicates)
+
+
+def read_predictions(csv_path):
+    """Prediction rows grouped by patch folder: {folder: [(row, patch_id)]}."""
+    by_folder = defaultdict(list)
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            match = PATCH_ID.match(os.path.splitext(row["image"])[0])
+            if match is None:
+                continue
+            patch_id = match.group(1)
+            by_folder[patch_id.rsplit("_patch_", 1)[0]].append((row, patch_id))
+    return by_folder
+
+
+def build_catalog(csv_path=PREDICTIONS_CSV, db_path=CATALOG_DB):
+    start = time.perf_counter()
+    by_folder = read_predictions(csv_path)
+    records = []
+    for folder, rows in sorted(by_folder.items()):
+        found = georeference_folder(folder, rows)
+        print(f"🌍 {folder}: {len(found)}/{len(rows)} detections georeferenced")
+        records.extend(found)
+
+    catalog = DetectionCatalog(db_path)
+    n = catalog.rebuild(records)
+    merged = catalog.merge_duplicates()
+    print(f"✅ Catalog: {n} detections, {merged} duplicates across strips ({time.perf_counter() - start:.1f}s)")
+    return catalog
+
+
+if __name__ == "__main__":
+    if not os.path.exists(PREDICTIONS_CSV):
+        print(f"⚠ Predictions not found: {PREDICTIONS_CSV}")
+    else:
+        with build_catalog() as catalog:
+            if QUERY_LON is not None:
+                start = time.perf_counter()
+                hits = catalog.within(QUERY_LON, QUERY_LAT, QUERY_RADIUS_M)
+                print(f"🔎 {len(hits)} detections within {QUERY_RADIUS_M:.0f} m of "
+                      f"({QUERY_LON}, {QUERY_LAT}) in {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,188 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+from sklearn.cluster import MiniBatchKMeans
+from patch_store import PatchStore, is_store
+from patches_for_annotation import select_kcenter, copy_selected
+
+# ==============================================================
+# CONFIGURATION
+# ==============================================================
+MODEL_PATH = r"C:/Users/Amma.DESKTOP-4K4SV7F/Desktop/dl_code/runs/train/moon_detection_full_pipeline11/weights/best.pt"
+PATCH_ROOT = "D:/DL/DATA/patches/ohrc_png"      # OHRC subfolders of PNGs or patch stores
+INDEX_DIR = "D:/DL/DATA/embedding_index"        # embeddings.npy + IVF index files
+DEST_ROOT = "D:/DL/DATA/selected_patches"       # where select_diverse() picks are copied
+BATCH_SIZE = 32                                 # patches per CPU forward pass
+IMGSZ = 640                                     # same input size as training
+EMBED_LAYER = 9                                 # last backbone layer (SPPF) of YOLOv8; nothing after it runs
+NLIST = 1024                                    # IVF lists (coarse clusters)
+NPROBE = 16                                     # lists scanned per query
+TRAIN_SAMPLE = 100_000                          # rows used to fit the coarse quantizer
+SELECT_BUDGET = 0                               # >0: copy this many embedding-diverse patches to DEST_ROOT
+
+# Layout of INDEX_DIR:
+#   embeddings.npy   (n, d) float32, L2-normalised, opened with mmap_mode='r'
+#   ids.npy/folders.npy   patch name and source folder of each row
+#   centroids.npy    (nlist, d) coarse centroids
+#   ivf_order.npy    row numbers grouped by list; ivf_offsets.npy marks where each list starts
+
+
+def list_patches(root):
+    """(patch_id, folder_path) for every patch under root, PNG folders and stores alike."""
+    items = []
+    for sub in sorted(os.listdir(root)):
+        folder = os.path.join(root, sub)
+        if not os.path.isdir(folder):
+            continue
+        if is_store(folder):
+            items.extend((pid, folder) for pid in PatchStore(folder).ids())
+        else:
+            items.extend((os.path.splitext(f)[0], folder) for f in sorted(os.listdir(folder)) if f.endswith(".png"))
+    return items
+
+
+def load_batch(items, stores):
+    """3-channel uint8 arrays for a batch of (patch_id, folder) items."""
+    images = []
+    for pid, folder in items:
+        if is_store(folder):
+            store = stores.setdefault(folder, PatchStore(folder))
+            gray = np.asarray(store.get(pid), dtype=np.uint8)
+        else:
+            gray = np.array(Image.open(os.path.join(folder, pid + ".png")).convert("L"))
+        images.append(np.repeat(gray[:, :, None], 3, axis=2))
+    return images
+
+
+def build_index(root=PATCH_ROOT, index_dir=INDEX_DIR, model_path=MODEL_PATH):
+    from ultralytics import YOLO
+
+    os.makedirs(index_dir, exist_ok=True)
+    items = list_patches(root)
+    if not items:
+        print(f"⚠ No patches found under {root}")
+        return None
+    model = YOLO(model_path)
+    stores = {}
+    embeddings = None
+    start = time.perf_counter()
+
+    # -------- EMBED IN CPU BATCHES --------
+    for b in range(0, len(items), BATCH_SIZE):
+        batch = load_batch(items[b:b + BATCH_SIZE], stores)
+        vectors = model.embed(batch, imgsz=IMGSZ, device='cpu', embed=[EMBED_LAYER], verbose=False)
+        vectors = np.stack([v.cpu().numpy() for v in vectors]).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(os.path.join(index_dir, "embeddings.npy"), mode='w+',
+                                                   dtype=np.float32, shape=(len(items), vectors.shape[1]))
+        embeddings[b:b + len(vectors)] = vectors
+        if (b // BATCH_SIZE) % 50 == 0:
+            print(f"🧠 Embedded {b + len(vectors)}/{len(items)} patches")
+    embeddings.flush()
+    np.save(os.path.join(index_dir, "ids.npy"), np.array([pid for pid, _ in items]))
+    np.save(os.path.join(index_dir, "folders.npy"), np.array([folder for _, folder in items]))
+    print(f"✅ Embedded {len(items)} patches in {time.perf_counter() - start:.1f}s")
+
+    # -------- IVF COARSE QUANTIZER --------
+    n = len(items)
+    rng = np.random.default_rng(42)
+    sample = embeddings[np.sort(rng.choice(n, size=min(n, TRAIN_SAMPLE), replace=False))]
+    nlist = min(NLIST, len(sample))
+    quantizer = MiniBatchKMeans(n_clusters=nlist, random_state=42, batch_size=4096, n_init=3).fit(sample)
+    centroids = quantizer.cluster_centers_.astype(np.float32)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+
+    assign = np.empty(n, dtype=np.int32)
+    for b in range(0, n, 65536):
+        assign[b:b + 65536] = np.argmax(embeddings[b:b + 65536] @ centroids.T, axis=1)
+    order = np.argsort(assign, kind='stable')
+    offsets = np.searchsorted(assign[order], np.arange(nlist + 1))
+    np.save(os.path.join(index_dir, "centroids.npy"), centroids)
+    np.save(os.path.join(index_dir, "ivf_order.npy"), order)
+    np.save(os.path.join(index_dir, "ivf_offsets.npy"), offsets)
+    print(f"✅ IVF index with {nlist} lists written to {index_dir}")
+    return EmbeddingIndex(index_dir)
+
+
+class EmbeddingIndex:
+    def __init__(self, index_dir=INDEX_DIR):
+        self.embeddings = np.load(os.path.join(index_dir, "embeddings.npy"), mmap_mode='r')
+        self.ids = np.load(os.path.join(index_dir, "ids.npy"))
+        self.folders = np.load(os.path.join(index_dir, "folders.npy"))
+        self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+        self.order = np.load(os.path.join(index_dir, "ivf_order.npy"))
+        self.offsets = np.load(os.path.join(index_dir, "ivf_offsets.npy"))
+        self.row_of = {pid: i for i, pid in enumerate(self.ids)}
+
+    def _list(self, k):
+        return self.order[self.offsets[k]:self.offsets[k + 1]]
+
+    def search(self, vector, k=10, nprobe=NPROBE):
+        """Approximate top-k cosine neighbours of a vector: [(patch_id, folder, score)]."""
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) + 1e-12)
+        probes = np.argsort(-(self.centroids @ vector))[:nprobe]
+        rows = np.sort(np.concatenate([self._list(p) for p in probes]))
+        if len(rows) == 0:
+            return []
+        scores = self.embeddings[rows] @ vector
+        top = np.argsort(-scores)[:k]
+        return [(str(self.ids[rows[t]]), str(self.folders[rows[t]]), float(scores[t])) for t in top]
+
+    def similar_to(self, patch_id, k=10, nprobe=NPROBE):
+        """Patches most similar to an indexed patch, excluding the patch itself."""
+        row = self.row_of[patch_id]
+        hits = self.search(self.embeddings[row], k + 1, nprobe)
+        return [h for h in hits if h[0] != patch_id][:k]
+
+    def select_diverse(self, budget):
+        """`budget` mutually distant patches: lists in k-center order over the centroids, one patch per list per round."""
+        nonempty = np.flatnonzero(np.diff(self.offsets) > 0)
+        total = int(self.offsets[-1])
+        if budget > total:
+            print(f"⚠ Budget {budget} exceeds {total} indexed patches; selecting {total}")
+            budget = total
+        order = [int(k) for k in nonempty[select_kcenter(self.centroids[nonempty], len(nonempty))]]
+        ordered = set(order)
+        order += [int(k) for k in nonempty if k not in ordered]     # lists with duplicate centroids go last
+
+        # round-robin quotas: every round gives one more patch to each list that still has some
+        sizes = np.diff(self.offsets)
+        quota = dict.fromkeys(order, 0)
+        taken = 0
+        while taken < budget:
+            for k in order:
+                if taken < budget and quota[k] < sizes[k]:
+                    quota[k] += 1
+                    taken += 1
+
+        # within a list: the member closest to the centroid, then farthest-first from what is picked
+        per_list = {}
+        for k in order:
+            if quota[k] == 0:
+                continue                    # small budgets leave most lists without a pick
+            rows = np.sort(self._list(k))
+            X = self.embeddings[rows]
+            picked = [int(np.argmax(X @ self.centroids[k]))]
+            min_dist = np.linalg.norm(X - X[picked[0]], axis=1)
+            while len(picked) < quota[k]:
+                min_dist[picked] = -1       # never pick a row twice, even among exact duplicates
+                pick = int(np.argmax(min_dist))
+                picked.append(pick)
+                min_dist = np.minimum(min_dist, np.linalg.norm(X - X[pick], axis=1))
+            per_list[k] = rows[picked]
+        picks = [per_list[k][r] for r in range(max(quota.values(), default=0)) for k in order if r < quota[k]]
+        return [(str(self.ids[r]), str(self.folders[r])) for r in picks]
+
+
+if __name__ == "__main__":
+    index = build_index()
+    if index is not None and SELECT_BUDGET:
+        by_folder = {}
+        for pid, folder in index.select_diverse(SELECT_BUDGET):
+            by_folder.setdefault(folder, []).append(pid)
+        for folder, names in by_folder.items():
+            copy_selected(folder, os.path.join(DEST_ROOT, os.path.basename(folder)), names)
+    print("🎉 Embedding index ready.")
@@ -0,0 +1,72 @@
+import os
+import numpy as np
+
+# -------- INCREMENTAL FEATURE CACHE --------
+# One .npz per folder holding patch ids, the stat stamp each row was computed
+# from, and the feature matrix. Rows whose id or stamp no longer matches the
+# current listing are recomputed; rows for patches that disappeared are dropped
+# when the cache is rewritten.
+
+
+def file_stamp(*paths):
+    """(mtime_ns, size) of every path, flattened; missing files stamp as (0, 0)."""
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamp.extend([st.st_mtime_ns, st.st_size])
+        except OSError:
+            stamp.extend([0, 0])
+    return stamp
+
+
+def load_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            return {pid: (tuple(stamp), row) for pid, stamp, row in zip(data["ids"], data["stamps"], data["features"])}
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable feature cache {cache_path}: {e}")
+        return {}
+
+
+def save_cache(cache_path, ids, stamps, features):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + ".tmp.npz"
+    np.savez(tmp_path, ids=np.array(ids, dtype=str), stamps=np.array(stamps, dtype=np.int64).reshape(len(ids), -1),
+             features=features)
+    os.replace(tmp_path, cache_path)
+
+
+def cached_features(cache_path, ids, stamps, compute):
+    """Features for every id, calling compute(indices) -> (m, F) only for new or changed patches.
+
+    Returns (features, number of rows served from the cache); features is None when ids is empty.
+    """
+    if len(ids) == 0:
+        # nothing left to describe: drop a stale cache instead of rewriting it empty
+        if cache_path and os.path.exists(cache_path):
+            os.remove(cache_path)
+        return None, 0
+
+    cache = load_cache(cache_path) if cache_path else {}
+    hits, missing = {}, []
+    for i, (pid, stamp) in enumerate(zip(ids, stamps)):
+        entry = cache.get(pid)
+        if entry is not None and entry[0] == tuple(stamp):
+            hits[i] = entry[1]
+        else:
+            missing.append(i)
+
+    computed = compute(missing) if missing else None
+    width = computed.shape[1] if computed is not None else (len(next(iter(hits.values()))) if hits else 0)
+    features = np.empty((len(ids), width), dtype=np.float64)
+    for i, row in hits.items():
+        features[i] = row
+    if missing:
+        features[missing] = computed
+
+    if cache_path and (missing or len(cache) != len(ids)):
+        save_cache(cache_path, ids, stamps, features)
+    return features, len(hits)
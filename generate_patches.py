@@ -2,20 +2,49 @@ import os
 import numpy as np
 import rasterio
 from rasterio.transform import Affine
+from rasterio.windows import Window
 import json
 import csv
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from PIL import Image
 import xml.etree.ElementTree as ET
+from geolocation import GeoGrid
+from patch_store import PatchStoreWriter
+from patch_metadata import MetadataTable
+from instrumentation import stage, track
+from tiling import tile_blocks, tile_stats, reject_reasons
 
 # -------- CONFIG --------
 INPUT_DIR = "D:/DL/DATA/lunasurface_data"
 OUTPUT_DIR = "D:/DL/DATA/patches"
 PATCH_SIZE = 512
 FORMATS = ['ohrc', 'tmc', 'dtm']
+USE_MEMMAP = True        # map one 512-row band of image.img at a time instead of loading the strip
+TIF_WINDOWED = True      # read TMC/DTM patches through rasterio windows instead of src.read(1)
+OUTPUT_BACKEND = "files"  # "files": .img/.tif + .json per patch, "shards": PatchStore shard files
+OHRC_OUTPUT_FORMAT = "img"  # "img" = raw patches for ohrc_img_to_png; "png" (or any PIL format) = encode directly
+COMPRESS_LEVEL = 1          # PNG zlib level (0-9): low levels are much faster for a small size cost
+ENCODE_THREADS = 4          # threads encoding OHRC tiles per folder
+METADATA_DB = "patch_metadata.sqlite"  # run-wide metadata table inside OUTPUT_DIR (None = JSON files only)
+METADATA_BATCH = 1000                  # rows per metadata table insert
+WRITE_JSON = True                      # keep the per-patch .json files next to the patches
+NUM_WORKERS = max(1, (os.cpu_count() or 2) - 1)   # folders tiled in parallel (1 = sequential)
+DONE_MARKER = "_complete.json"                     # written into a patch folder once it is fully tiled
+REJECT_MANIFEST = "_rejected.csv"                  # tiles skipped by REJECT_RULES, written into the patch folder
+OHRC_NODATA = None          # OHRC fill value; None = PDS4 label's missing_constant, else the strip margin value
+MARGIN_FILL_SHARE = 0.95    # share of edge-column pixels that must hold one value for it to count as margin fill
+# Opt-in tile screening: tiles failing any threshold of their format's rule are never written
+# (None = no check; formats without a rule keep all their tiles). std is in the product's own
+# units (DN for OHRC), so TMC relies on the range-independent entropy check and flat DTM
+# terrain is only rejected for missing data. Example:
+#   {"ohr": {"min_valid": 0.9, "min_std": 2.0, "min_entropy": 2.0, "max_saturated": 0.5},
+#    "tmc": {"min_valid": 0.9, "min_entropy": 2.0, "max_saturated": 0.5},
+#    "dtm": {"min_valid": 0.9}}
+REJECT_RULES = {}
 
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
 # -------- READ IMAGE SIZE FROM XML --------
 
 
@@ -42,6 +71,45 @@ def get_img_size_from_metadata(folder_path):
                 print(f"❌ XML parse error: {e}")
     return None
 
+
+def get_missing_constant(folder_path):
+    """missing_constant from the PDS4 label's Special_Constants, or None when the label has none."""
+    for file in os.listdir(folder_path):
+        if file.endswith(".xml") and "meta" in file.lower():
+            try:
+                root = ET.parse(os.path.join(folder_path, file)).getroot()
+                value = root.find(".//pds:Special_Constants/pds:missing_constant",
+                                  {'pds': 'http://pds.nasa.gov/pds4/pds/v1'})
+                if value is not None and value.text:
+                    return float(value.text)
+            except Exception as e:
+                print(f"❌ XML parse error: {e}")
+    return None
+
+
+def margin_fill_value(folder_path, samples=4096):
+    """Value filling the strip's left or right margin, or None when neither edge column is uniform."""
+    img_path = os.path.join(folder_path, "image.img")
+    size = get_img_size_from_metadata(folder_path)
+    if not size or not os.path.exists(img_path):
+        return None
+    width, height = size
+    data = np.memmap(img_path, dtype=np.uint8, mode='r', shape=(height, width))
+    rows = data[::max(1, height // samples)]
+    for col in (0, width - 1):
+        counts = np.bincount(np.asarray(rows[:, col]), minlength=256)
+        if counts.max() >= MARGIN_FILL_SHARE * rows.shape[0]:
+            return int(counts.argmax())
+    return None
+
+
+def ohrc_nodata(folder_path):
+    """OHRC fill value: OHRC_NODATA if set, else the label's missing_constant, else the margin fill."""
+    if OHRC_NODATA is not None:
+        return OHRC_NODATA
+    value = get_missing_constant(folder_path)
+    return value if value is not None else margin_fill_value(folder_path)
+
 # -------- CONVERT .img (only for OHRC) --------
 
 
@@ -61,6 +129,38 @@ def convert_img_to_array(folder_path):
         print(f"❌ Failed to load raw .img: {e}")
         return None
 
+
+def encode_patch(patch, out_path, fmt):
+    """Encode one OHRC tile to an image file; the .part rename keeps interrupted files out of the tree."""
+    options = {"compress_level": COMPRESS_LEVEL} if fmt == "png" else {}
+    tmp_path = out_path + ".part"
+    Image.fromarray(np.asarray(patch, dtype=np.uint8)).save(tmp_path, format=fmt.upper(), **options)
+    os.replace(tmp_path, out_path)
+
+
+def open_img_bands(folder_path, band_rows=PATCH_SIZE):
+    """Memory-map image.img one band of rows at a time; returns a (row_off, band) generator."""
+    img_path = os.path.join(folder_path, "image.img")
+    if not os.path.exists(img_path):
+        return None
+    size = get_img_size_from_metadata(folder_path)
+    if not size:
+        print(f"❌ Cannot determine size for: {img_path}")
+        return None
+    width, height = size
+    if os.path.getsize(img_path) < width * height:
+        print(f"❌ {img_path} is smaller than {width}x{height} from meta.xml")
+        return None
+
+    def bands():
+        for row_off in range(0, height, band_rows):
+            rows = min(band_rows, height - row_off)
+            # each band gets its own mapping, so its pages are released once the caller moves on
+            yield row_off, np.memmap(img_path, dtype=np.uint8, mode='r',
+                                     offset=row_off * width, shape=(rows, width))
+
+    return bands()
+
 # -------- METADATA UTILS --------
 
 
@@ -154,93 +254,256 @@ def interpolate_coords(coords_map, x, y):
 # -------- PROCESS EACH FOLDER --------
 
 
+def iter_array_patches(bands, transform=None, rules=None, nodata=None, rejected=None):
+    """Yield (index, y, x, patch, patch_transform) over in-memory or memory-mapped bands.
+
+    Each band (rows a multiple of PATCH_SIZE apart) is cut into a zero-copy block
+    view and its tiles are screened together; tiles failing `rules` are appended to
+    `rejected` as (index, y, x, reason, stats) instead of being yielded. Indices are
+    row-major over the whole image either way, so patch ids do not depend on the rules.
+    """
+    for row_off, band in bands:
+        blocks = tile_blocks(band, PATCH_SIZE)
+        rows, cols = blocks.shape[:2]
+        if rows * cols == 0:
+            continue
+        if rules:
+            stats = tile_stats(blocks, nodata)
+            reasons = reject_reasons(stats, **rules)
+        for r, c in np.ndindex(rows, cols):
+            index = (row_off // PATCH_SIZE + r) * cols + c
+            y, x = row_off + r * PATCH_SIZE, c * PATCH_SIZE
+            if rules and reasons[r, c]:
+                if rejected is not None:
+                    rejected.append((index, y, x, reasons[r, c], {k: float(v[r, c]) for k, v in stats.items()}))
+                continue
+            patch_transform = transform * Affine.translation(x, y) if transform is not None else None
+            yield index, y, x, blocks[r, c], patch_transform
+
+
+def iter_tif_window_patches(image_path, rules=None, rejected=None):
+    """Read image.tif one patch window at a time, visiting windows in the file's block order.
+
+    Yields the same (index, y, x, patch, patch_transform) as iter_array_patches and
+    screens each window with the same statistics when `rules` are given.
+    """
+    with rasterio.open(image_path) as src:
+        rows, cols = src.height // PATCH_SIZE, src.width // PATCH_SIZE
+        block_h, block_w = src.block_shapes[0]
+
+        def block_order(cell):
+            r, c = cell
+            return (r * PATCH_SIZE) // block_h, (c * PATCH_SIZE) // block_w, r, c
+
+        for r, c in sorted(((r, c) for r in range(rows) for c in range(cols)), key=block_order):
+            window = Window(c * PATCH_SIZE, r * PATCH_SIZE, PATCH_SIZE, PATCH_SIZE)
+            # index stays row-major so patch ids match the full-read path
+            index, y, x = r * cols + c, r * PATCH_SIZE, c * PATCH_SIZE
+            patch = src.read(1, window=window)
+            if rules:
+                stats = tile_stats(patch[None, None], src.nodata)
+                reason = reject_reasons(stats, **rules)[0, 0]
+                if reason:
+                    if rejected is not None:
+                        rejected.append((index, y, x, reason, {k: float(v[0, 0]) for k, v in stats.items()}))
+                    continue
+            yield index, y, x, patch, src.window_transform(window)
+
+
+def write_reject_manifest(patch_dir, folder_name, rejected):
+    with open(os.path.join(patch_dir, REJECT_MANIFEST), "w", newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["patch_id", "pixel_x", "pixel_y", "reason", "valid_fraction", "std", "entropy",
+                         "saturated_fraction"])
+        for index, y, x, reason, stats in sorted(rejected, key=lambda item: item[0]):
+            writer.writerow([f"{folder_name}_patch_{index:04d}", x, y, reason, round(stats["valid_fraction"], 4),
+                             round(stats["std"], 3), round(stats["entropy"], 3),
+                             round(stats["saturated_fraction"], 4)])
+
+
 def process_folder(folder_path, folder_name):
     patch_dir = os.path.join(OUTPUT_DIR, folder_name)
     os.makedirs(patch_dir, exist_ok=True)
 
     is_ohr = "ohr" in folder_name
+    rules = next((r for key, r in REJECT_RULES.items() if key in folder_name), None)
+    rejected = []
     sun_elev, sun_azim = load_spm(folder_path) if is_ohr else (None, None)
     yaw, roll, pitch = load_oat(folder_path) if is_ohr else (None, None, None)
     coords_map = load_csv_coords(folder_path) if is_ohr else {}
 
     if is_ohr:
-        data = convert_img_to_array(folder_path)
-        if data is None:
+        if USE_MEMMAP:
+            bands = open_img_bands(folder_path)
+        else:
+            data = convert_img_to_array(folder_path)
+            bands = None if data is None else [(0, data)]
+        if bands is None:
             print(f"⚠️ Skipping {folder_name} (img not loaded)")
-            return
-        height, width = data.shape
-        transform = Affine.identity()
+            return None
+        nodata = ohrc_nodata(folder_path) if rules else None
+        patches = iter_array_patches(bands, rules=rules, nodata=nodata, rejected=rejected)
+
+        # geolocate every patch centre of the strip in one vectorized lookup
+        geo = GeoGrid.from_coords_map(coords_map)
+        width, height = get_img_size_from_metadata(folder_path)
+        centre_lon, centre_lat = geo.patch_centres(width, height, PATCH_SIZE) if geo else (None, None)
     else:
         image_path = os.path.join(folder_path, "image.tif")
         if not os.path.exists(image_path):
             print(f"⚠️ Missing image.tif in {folder_name}")
-            return
-        with rasterio.open(image_path) as src:
-            data = src.read(1)
-            height, width = src.height, src.width
-            transform = src.transform
-
+            return None
+        if TIF_WINDOWED:
+            patches = iter_tif_window_patches(image_path, rules=rules, rejected=rejected)
+        else:
+            with rasterio.open(image_path) as src:
+                data = src.read(1)
+                transform, nodata = src.transform, src.nodata
+            patches = iter_array_patches([(0, data)], transform, rules=rules, nodata=nodata, rejected=rejected)
+
+    store = PatchStoreWriter(patch_dir) if OUTPUT_BACKEND == "shards" else None
+    table = MetadataTable(os.path.join(OUTPUT_DIR, METADATA_DB)) if METADATA_DB else None
+    pending_meta = []
+    encode_direct = is_ohr and store is None and OHRC_OUTPUT_FORMAT != "img"
+    encoder = ThreadPoolExecutor(max_workers=ENCODE_THREADS) if encode_direct else None
+    in_flight = set()
     count = 0
-    for y in range(0, height, PATCH_SIZE):
-        for x in range(0, width, PATCH_SIZE):
-            patch = data[y:y+PATCH_SIZE, x:x+PATCH_SIZE]
-            if patch.shape != (PATCH_SIZE, PATCH_SIZE):
-                continue
-
-            patch_id = f"{folder_name}_patch_{count:04d}"
-            patch_meta = {
-                "patch_id": patch_id,
-                "pixel_x": x,
-                "pixel_y": y
+    for index, y, x, patch, patch_transform in track(patches):
+        patch_id = f"{folder_name}_patch_{index:04d}"
+        patch_meta = {
+            "patch_id": patch_id,
+            "pixel_x": x,
+            "pixel_y": y
+        }
+        if not is_ohr:
+            patch_meta["transform"] = list(patch_transform)
+
+        # OHRC extras
+        if is_ohr:
+            if sun_elev is not None:
+                patch_meta["sun_elevation"] = sun_elev
+                patch_meta["sun_azimuth"] = sun_azim
+            if yaw is not None:
+                patch_meta["satellite_yaw"] = yaw
+                patch_meta["satellite_roll"] = roll
+                patch_meta["satellite_pitch"] = pitch
+            if centre_lon is not None and not np.isnan(centre_lon[y // PATCH_SIZE, x // PATCH_SIZE]):
+                patch_meta["longitude"] = float(centre_lon[y // PATCH_SIZE, x // PATCH_SIZE])
+                patch_meta["latitude"] = float(centre_lat[y // PATCH_SIZE, x // PATCH_SIZE])
+
+        if table is not None:
+            pending_meta.append(patch_meta)
+            if len(pending_meta) >= METADATA_BATCH:
+                table.insert_many(folder_name, pending_meta)
+                pending_meta = []
+
+        if store is not None:
+            store.add(patch_id, patch.astype(np.uint8) if is_ohr else patch, patch_meta)
+            count += 1
+            continue
+
+        if encode_direct:
+            patch_path = os.path.join(patch_dir, f"{patch_id}.{OHRC_OUTPUT_FORMAT}")
+            if not os.path.exists(patch_path):
+                # bound the queue so only a few tiles (and their bands) are held at once
+                if len(in_flight) >= ENCODE_THREADS * 4:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                in_flight.add(encoder.submit(encode_patch, patch, patch_path, OHRC_OUTPUT_FORMAT))
+        elif is_ohr:
+            patch_path = os.path.join(patch_dir, f"{patch_id}.img")
+            patch.astype(np.uint8).tofile(patch_path)
+        else:
+            patch_path = os.path.join(patch_dir, f"{patch_id}.tif")
+            meta = {
+                "driver": "GTiff",
+                "height": PATCH_SIZE,
+                "width": PATCH_SIZE,
+                "count": 1,
+                "dtype": patch.dtype,
+                "transform": patch_transform
             }
+            with rasterio.open(patch_path, "w", **meta) as dst:
+                dst.write(patch, 1)
 
-            if is_ohr:
-                patch_path = os.path.join(patch_dir, f"{patch_id}.img")
-                patch.astype(np.uint8).tofile(patch_path)
-            else:
-                patch_path = os.path.join(patch_dir, f"{patch_id}.tif")
-                meta = {
-                    "driver": "GTiff",
-                    "height": PATCH_SIZE,
-                    "width": PATCH_SIZE,
-                    "count": 1,
-                    "dtype": data.dtype,
-                    "transform": generate_metadata(transform, y, x)
-                }
-                with rasterio.open(patch_path, "w", **meta) as dst:
-                    dst.write(patch, 1)
-                patch_meta["transform"] = list(meta["transform"])
-
-            # OHRC extras
-            if is_ohr:
-                if sun_elev is not None:
-                    patch_meta["sun_elevation"] = sun_elev
-                    patch_meta["sun_azimuth"] = sun_azim
-                if yaw is not None:
-                    patch_meta["satellite_yaw"] = yaw
-                    patch_meta["satellite_roll"] = roll
-                    patch_meta["satellite_pitch"] = pitch
-                lon, lat = interpolate_coords(coords_map, x + PATCH_SIZE//2, y + PATCH_SIZE//2)
-                if lon is not None:
-                    patch_meta["longitude"] = lon
-                    patch_meta["latitude"] = lat
-
+        if WRITE_JSON:
             with open(os.path.join(patch_dir, f"{patch_id}.json"), "w", encoding='utf-8') as jf:
                 json.dump(patch_meta, jf, indent=2)
 
-            count += 1
-    print(f"✅ {folder_name}: {count} patches")
+        count += 1
+    if encoder is not None:
+        for future in in_flight:
+            future.result()
+        encoder.shutdown()
+    if store is not None:
+        store.close()
+    if table is not None:
+        if pending_meta:
+            table.insert_many(folder_name, pending_meta)
+        table.close()
+    if rules:
+        write_reject_manifest(patch_dir, folder_name, rejected)
+    print(f"✅ {folder_name}: {count} patches" + (f", {len(rejected)} rejected" if rejected else ""))
+    return count
+
+
+def run_folder(folder_path, folder_name):
+    """Tile one folder and mark it complete, so an interrupted run can resume after it."""
+    start = time.perf_counter()
+    with stage("generate_patches.folder", folder=folder_name) as st:
+        count = process_folder(folder_path, folder_name)
+        image = next((os.path.join(folder_path, f) for f in ("image.img", "image.tif")
+                      if os.path.exists(os.path.join(folder_path, f))), None)
+        st.count(patches=count or 0, bytes=os.path.getsize(image) if count and image else 0)
+    seconds = time.perf_counter() - start
+    if count is not None:
+        marker = {"folder": folder_name, "patches": count, "seconds": round(seconds, 3), "worker": os.getpid()}
+        with open(os.path.join(OUTPUT_DIR, folder_name, DONE_MARKER), "w", encoding='utf-8') as mf:
+            json.dump(marker, mf, indent=2)
+    return folder_name, count or 0, seconds, os.getpid()
+
+
+def pending_folders():
+    """List (folder_path, folder_name) for every input folder without a completion marker."""
+    jobs = []
+    for fmt in FORMATS:
+        folder_root = os.path.join(INPUT_DIR, fmt)
+        for folder in sorted(os.listdir(folder_root)):
+            folder_path = os.path.join(folder_root, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            if os.path.exists(os.path.join(OUTPUT_DIR, folder, DONE_MARKER)):
+                print(f"⏩ Already tiled: {folder}")
+                continue
+            jobs.append((folder_path, folder))
+    return jobs
 
 # -------- MAIN --------
 
 
 if __name__ == "__main__":
-    for fmt in FORMATS:
-        folder_root = os.path.join(INPUT_DIR, fmt)
-        for folder in sorted(os.listdir(folder_root)):
-            folder_path = os.path.join(folder_root, folder)
-            if os.path.isdir(folder_path):
-                print(f"\n🔍 Processing: {folder}")
-                process_folder(folder_path, folder)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    jobs = pending_folders()
+    per_worker = defaultdict(lambda: [0, 0.0])
+
+    if NUM_WORKERS > 1 and len(jobs) > 1:
+        print(f"\n🚀 Tiling {len(jobs)} folders on {NUM_WORKERS} workers")
+        with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+            futures = [pool.submit(run_folder, path, name) for path, name in jobs]
+            for future in as_completed(futures):
+                name, count, seconds, pid = future.result()
+                per_worker[pid][0] += count
+                per_worker[pid][1] += seconds
+    else:
+        for folder_path, folder in jobs:
+            print(f"\n🔍 Processing: {folder}")
+            name, count, seconds, pid = run_folder(folder_path, folder)
+            per_worker[pid][0] += count
+            per_worker[pid][1] += seconds
+
+    for pid, (count, seconds) in sorted(per_worker.items()):
+        rate = count / seconds if seconds else 0.0
+        print(f"⏱️ worker {pid}: {count} patches in {seconds:.1f}s ({rate:.1f} patches/s)")
 
     print("\n🎉 Done generating patches and enriched metadata JSONs.")
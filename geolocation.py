@@ -0,0 +1,93 @@
+import numpy as np
+
+# -------- VECTORIZED GEOLOCATION --------
+# coords.csv gives lon/lat at a sparse grid of (Pixel, Scan) control points.
+# GeoGrid turns the coords_map from generate_patches.load_csv_coords into dense
+# NumPy arrays once per folder and answers bilinear lookups for whole arrays of
+# pixel positions (patch centres, patch corners, detection pixels) in one call.
+
+
+def _fill_line(values, positions):
+    """Fill NaN gaps along one axis by linear interpolation between known points."""
+    known = ~np.isnan(values)
+    if known.any() and not known.all():
+        values[~known] = np.interp(positions[~known], positions[known], values[known])
+    return values
+
+
+class GeoGrid:
+    def __init__(self, pixels, scans, lon, lat):
+        self.pixels = pixels    # sorted control-point columns (x)
+        self.scans = scans      # sorted control-point scan lines (y)
+        self.lon = lon          # shape (len(scans), len(pixels))
+        self.lat = lat
+
+    @classmethod
+    def from_coords_map(cls, coords_map):
+        """Build the grid from {scan: {pixel: (lon, lat)}}; returns None when there are no points."""
+        if not coords_map:
+            return None
+        scans = np.array(sorted(coords_map), dtype=np.float64)
+        pixels = np.array(sorted({px for line in coords_map.values() for px in line}), dtype=np.float64)
+        column = {int(px): j for j, px in enumerate(pixels)}
+
+        lon = np.full((len(scans), len(pixels)), np.nan)
+        lat = np.full((len(scans), len(pixels)), np.nan)
+        for i, scan in enumerate(sorted(coords_map)):
+            for px, (lo, la) in coords_map[scan].items():
+                lon[i, column[px]] = lo
+                lat[i, column[px]] = la
+
+        # close holes along each scan line first, then across scan lines
+        for grid in (lon, lat):
+            for row in grid:
+                _fill_line(row, pixels)
+            for col in grid.T:
+                _fill_line(col, scans)
+
+        # bilinear lookups need at least two control points per axis
+        if len(scans) == 1:
+            scans = np.append(scans, scans[0] + 1)
+            lon, lat = np.vstack([lon, lon]), np.vstack([lat, lat])
+        if len(pixels) == 1:
+            pixels = np.append(pixels, pixels[0] + 1)
+            lon, lat = np.hstack([lon, lon]), np.hstack([lat, lat])
+        return cls(pixels, scans, lon, lat)
+
+    def lookup(self, x, y):
+        """Bilinear lon/lat for arrays of pixel positions.
+
+        Rows beyond the first/last scan line clamp to it, as interpolate_coords did;
+        columns outside the control points come back as NaN.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.clip(np.asarray(y, dtype=np.float64), self.scans[0], self.scans[-1])
+
+        i = np.clip(np.searchsorted(self.scans, y, side='right') - 1, 0, len(self.scans) - 2)
+        j = np.clip(np.searchsorted(self.pixels, x, side='right') - 1, 0, len(self.pixels) - 2)
+        ty = (y - self.scans[i]) / (self.scans[i + 1] - self.scans[i])
+        tx = (x - self.pixels[j]) / (self.pixels[j + 1] - self.pixels[j])
+
+        outside = (x < self.pixels[0]) | (x > self.pixels[-1])
+        result = []
+        for grid in (self.lon, self.lat):
+            top = grid[i, j] * (1 - tx) + grid[i, j + 1] * tx
+            bottom = grid[i + 1, j] * (1 - tx) + grid[i + 1, j + 1] * tx
+            values = top * (1 - ty) + bottom * ty
+            result.append(np.where(outside, np.nan, values))
+        return result[0], result[1]
+
+    def patch_centres(self, width, height, patch_size):
+        """Lon/lat of every full patch centre, as (rows, cols) arrays in tiling order."""
+        ys = np.arange(height // patch_size) * patch_size + patch_size // 2
+        xs = np.arange(width // patch_size) * patch_size + patch_size // 2
+        yy, xx = np.meshgrid(ys, xs, indexing='ij')
+        return self.lookup(xx, yy)
+
+    def patch_corners(self, x, y, patch_size):
+        """Lon/lat of the four corners of patches at (x, y), each shaped (..., 4): TL, TR, BR, BL."""
+        x = np.asarray(x, dtype=np.float64)[..., None]
+        y = np.asarray(y, dtype=np.float64)[..., None]
+        dx = np.array([0, patch_size, patch_size, 0], dtype=np.float64)
+        dy = np.array([0, 0, patch_size, patch_size], dtype=np.float64)
+        return self.lookup(x + dx, y + dy)
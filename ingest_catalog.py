@@ -0,0 +1,181 @@
+import os
+import time
+import zlib
+import sqlite3
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from zip_ingest import INGEST_WORKERS, COPY_BUFFER, list_sources, classify, plan_copies, copy_members
+
+# -------- PERSISTENT INGEST CATALOG --------
+# SQLite record of every source (ZIP or unzipped folder) and member seen so far:
+# size, mtime, CRC32, SHA-256 once copied, timestamp, classification and the
+# final file it was copied to. Unchanged sources are skipped on their size/mtime
+# alone, so a new data drop only costs time for the new files. Members whose
+# content is already in the tree, or whose destination file is already taken,
+# are recorded as duplicates and not copied. A member whose size or CRC changes
+# on a rescan loses its dest and hash so it is copied again.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, scanned_at REAL);
+CREATE TABLE IF NOT EXISTS members (
+    source TEXT, member TEXT, size INTEGER, mtime INTEGER, crc INTEGER, sha256 TEXT,
+    timestamp TEXT, kind TEXT, target TEXT, dest TEXT, duplicate_of TEXT,
+    PRIMARY KEY (source, member));
+CREATE INDEX IF NOT EXISTS idx_members_kind ON members (kind, timestamp);
+"""
+
+
+def source_fingerprint(source):
+    """(size, mtime_ns) of a ZIP, or the total size / newest mtime of an unzipped folder."""
+    if not os.path.isdir(source):
+        st = os.stat(source)
+        return st.st_size, st.st_mtime_ns
+    size = mtime = 0
+    for root, _, files in os.walk(source):
+        for file in files:
+            st = os.stat(os.path.join(root, file))
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime_ns)
+    return size, mtime
+
+
+def file_crc(path):
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_BUFFER):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def scan_members(source):
+    """(member, size, mtime, crc, label) for every file of a source; label comes from classify()."""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    rows = []
+    if source.endswith(".zip"):
+        # sizes and CRCs come straight from the central directory
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                folder, file = os.path.split(info.filename)
+                mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+                rows.append((info.filename, info.file_size, mtime, info.CRC,
+                             classify(os.path.join(stem, folder), file)))
+    else:
+        for root, _, files in os.walk(source):
+            for file in files:
+                path = os.path.join(root, file)
+                label = classify(os.path.join(stem, os.path.relpath(root, source)), file)
+                st = os.stat(path)
+                # only members that would be copied are worth reading for a CRC
+                rows.append((path, st.st_size, st.st_mtime_ns, file_crc(path) if label else None, label))
+    return rows
+
+
+class IngestCatalog:
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def source_changed(self, source, fingerprint):
+        row = self.conn.execute("SELECT size, mtime FROM sources WHERE path = ?", (source,)).fetchone()
+        return row is None or tuple(row) != tuple(fingerprint)
+
+    def record_source(self, source, fingerprint, rows):
+        """Store a (re)scanned source; members already copied keep their dest and hash unless their content changed."""
+        self.conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)", (source, *fingerprint, time.time()))
+        # SET expressions see the stored row, so "same" compares the old size/CRC with the rescanned ones
+        same = "(size IS excluded.size AND crc IS excluded.crc)"
+        for member, size, mtime, crc, label in rows:
+            kind, timestamp, target = label or (None, None, None)
+            self.conn.execute(
+                "INSERT INTO members (source, member, size, mtime, crc, timestamp, kind, target) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (source, member) DO UPDATE SET "
+                f"dest = CASE WHEN {same} THEN dest END, sha256 = CASE WHEN {same} THEN sha256 END, "
+                f"duplicate_of = CASE WHEN {same} THEN duplicate_of END, "
+                "size = excluded.size, mtime = excluded.mtime, crc = excluded.crc, "
+                "timestamp = excluded.timestamp, kind = excluded.kind, target = excluded.target",
+                (source, member, size, mtime, crc, timestamp, kind, target))
+        self.conn.commit()
+
+    def mark_duplicates(self):
+        """Flag pending members whose content or destination is already taken; returns how many."""
+        seen = {}
+        rows = self.conn.execute(
+            "SELECT source, member, kind, timestamp, target, size, crc, dest FROM members WHERE kind IS NOT NULL "
+            "AND duplicate_of IS NULL ORDER BY dest IS NULL, source, member").fetchall()
+        duplicates = []
+        for source, member, kind, timestamp, target, size, crc, dest in rows:
+            # same bytes, or another file bound for the same folder slot (product or metadata shipped again)
+            keys = [(kind, timestamp, size, crc), (kind, timestamp, target)]
+            original = next((seen[k] for k in keys if k in seen), None)
+            if original is not None and dest is None:
+                duplicates.append((original, source, member))
+                continue
+            for k in keys:
+                seen.setdefault(k, f"{source}::{member}")
+        self.conn.executemany("UPDATE members SET duplicate_of = ? WHERE source = ? AND member = ?", duplicates)
+        self.conn.commit()
+        return len(duplicates)
+
+    def pending(self):
+        """Classified members not yet copied, grouped like zip_ingest.classify_entries()."""
+        found = {}
+        for source, member, kind, timestamp, target in self.conn.execute(
+                "SELECT source, member, kind, timestamp, target FROM members "
+                "WHERE kind IS NOT NULL AND dest IS NULL AND duplicate_of IS NULL ORDER BY source, member"):
+            found.setdefault((kind, timestamp), []).append((source, member, target))
+        return found
+
+    def ohrc_folders(self):
+        return {ts: os.path.dirname(dest) for ts, dest in self.conn.execute(
+            "SELECT timestamp, dest FROM members WHERE kind IN ('ohr', 'ohr_meta') AND dest IS NOT NULL")}
+
+    def pair_folders(self):
+        """{timestamp: (tmc folder, dtm folder)} of TMC/DTM pairs already copied."""
+        folders = {}
+        for kind, ts, dest in self.conn.execute(
+                "SELECT kind, timestamp, dest FROM members WHERE kind IN ('tmc', 'dtm') AND dest IS NOT NULL"):
+            folders.setdefault(ts, {})[kind] = os.path.dirname(dest)
+        return {ts: (f["tmc"], f["dtm"]) for ts, f in folders.items() if len(f) == 2}
+
+    def record_copies(self, source, members, digests):
+        self.conn.executemany(
+            "UPDATE members SET dest = ?, sha256 = ? WHERE source = ? AND member = ?",
+            [(dest, digests.get(member), source, member) for member, dest in members])
+        self.conn.commit()
+
+
+def count_folders(target):
+    return len([d for d in os.listdir(target) if os.path.isdir(os.path.join(target, d))])
+
+
+def catalog_ingest(raw_dir, db_path, target_ohrc, target_tmc, target_dtm, workers=INGEST_WORKERS):
+    """Ingest only new or changed sources of raw_dir; returns (pairs, ohrc, duplicates)."""
+    with IngestCatalog(db_path) as catalog, ThreadPoolExecutor(max_workers=workers) as pool:
+        fingerprints = {s: source_fingerprint(s) for s in list_sources(raw_dir)}
+        changed = [s for s, fp in fingerprints.items() if catalog.source_changed(s, fp)]
+        print(f"🔍 {len(changed)} new or changed sources of {len(fingerprints)}")
+
+        for source, rows in zip(changed, pool.map(scan_members, changed)):
+            catalog.record_source(source, fingerprints[source], rows)
+        duplicates = catalog.mark_duplicates()
+
+        pair_start = max(count_folders(target_tmc), count_folders(target_dtm))
+        jobs, pairs, ohrc = plan_copies(catalog.pending(), target_ohrc, target_tmc, target_dtm,
+                                        ohrc_start=count_folders(target_ohrc), pair_start=pair_start,
+                                        known_ohrc=catalog.ohrc_folders(), known_pairs=catalog.pair_folders())
+        futures = {source: pool.submit(copy_members, source, members) for source, members in jobs.items()}
+        for source, future in futures.items():
+            catalog.record_copies(source, jobs[source], future.result())
+    return pairs, ohrc, duplicates
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import socket
+import cProfile
+import functools
+import tracemalloc
+import numpy as np
+
+try:
+    import resource
+except ImportError:          # Windows: no getrusage, peak RSS is reported as null
+    resource = None
+
+# -------- PIPELINE INSTRUMENTATION --------
+# Every script times its stages with `stage()` (context manager) or `@timed`
+# (decorator). Inside a stage, `count(patches=1, bytes=n)` adds to its counters
+# and `track(iterable)` / `item()` record per-item latency; both act on the
+# innermost open stage and do nothing outside one, so library functions can be
+# instrumented without knowing who calls them. On exit one JSON line is appended
+# to METRICS_FILE:
+#   {"ts", "stage", "labels", "host", "pid", "seconds", "counts",
+#    "rates": {"<count>_per_s", "MB_per_s"}, "latency_ms": {"n", "mean", "p50", "p99", "max"},
+#    "peak_rss_mb", "peak_traced_mb" (TRACE_MEMORY only), "profile" (PROFILE_DIR only)}
+# Several worker processes may append to the same file; each line is one write().
+# The settings below can be overridden with environment variables so any script
+# can be profiled without editing it.
+
+METRICS_FILE = os.environ.get("PIPELINE_METRICS", "pipeline_metrics.jsonl")   # "" disables the JSON lines
+TRACE_MEMORY = os.environ.get("PIPELINE_TRACE_MEMORY", "0") == "1"   # tracemalloc peak per stage (slows hot loops)
+PROFILE_DIR = os.environ.get("PIPELINE_PROFILE_DIR", "")             # write a cProfile .prof per stage here
+
+_active = []            # open stages of this process, innermost last
+
+
+class Stage:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counts = {}
+        self.latencies = []
+        self.profile = None
+
+    # -------- COUNTERS --------
+    def count(self, **amounts):
+        """Add to named counters, e.g. st.count(patches=1, bytes=len(data))."""
+        for key, value in amounts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def add_latency(self, seconds, n=1):
+        """Record per-item latency for n items that took `seconds` together (batched work)."""
+        self.latencies.extend([seconds / n] * n)
+
+    def item(self):
+        """Context manager timing one item of the stage's loop."""
+        return _ItemTimer(self)
+
+    def track(self, iterable):
+        """Yield from iterable, recording each item's latency (producing it + the loop body)."""
+        start = time.perf_counter()
+        for element in iterable:
+            yield element
+            now = time.perf_counter()
+            self.latencies.append(now - start)
+            start = now
+
+    # -------- LIFECYCLE --------
+    def __enter__(self):
+        if TRACE_MEMORY:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        if PROFILE_DIR and not any(st.profile for st in _active):     # one profiler at a time
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        _active.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _active.remove(self)
+        if self.profile is not None:
+            self.profile.disable()
+        record = {"ts": time.time(), "stage": self.name, "labels": self.labels, "host": socket.gethostname(),
+                  "pid": os.getpid(), "seconds": round(seconds, 6), "counts": self.counts,
+                  "rates": rates(self.counts, seconds), "peak_rss_mb": peak_rss_mb()}
+        if self.latencies:
+            record["latency_ms"] = latency_summary(self.latencies)
+        if TRACE_MEMORY:
+            record["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+        if self.profile is not None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            record["profile"] = os.path.join(PROFILE_DIR, f"{self.name}-{os.getpid()}-{int(time.time() * 1000)}.prof")
+            self.profile.dump_stats(record["profile"])
+        if exc_type is not None:
+            record["error"] = repr(exc)
+        emit(record)
+        return False
+
+
+class _ItemTimer:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.stage is not None:
+            self.stage.latencies.append(time.perf_counter() - self.start)
+        return False
+
+
+def stage(name, **labels):
+    """Time a block: `with stage("generate_patches.folder", folder=name) as st: ...`."""
+    return Stage(name, labels)
+
+
+def timed(name=None, **labels):
+    """Decorator form of stage(); the function runs as one stage named after it by default."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with Stage(name or f"{fn.__module__}.{fn.__name__}", labels):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def count(**amounts):
+    """Add to the counters of the innermost open stage (no-op outside a stage)."""
+    if _active:
+        _active[-1].count(**amounts)
+
+
+def track(iterable):
+    """Per-item latency on the innermost open stage; returns iterable unchanged outside a stage."""
+    return _active[-1].track(iterable) if _active else iterable
+
+
+def add_latency(seconds, n=1):
+    if _active:
+        _active[-1].add_latency(seconds, n)
+
+
+def item():
+    """Time one item on the innermost open stage (a no-op timer outside a stage)."""
+    return _ItemTimer(_active[-1] if _active else None)
+
+
+# -------- HELPERS --------
+def peak_rss_mb():
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)      # KiB on Linux
+
+
+def rates(counts, seconds):
+    if seconds <= 0:
+        return {}
+    out = {f"{key}_per_s": round(value / seconds, 3) for key, value in counts.items() if key != "bytes"}
+    if "bytes" in counts:
+        out["MB_per_s"] = round(counts["bytes"] / 1e6 / seconds, 3)
+    return out
+
+
+def latency_summary(latencies):
+    ms = np.asarray(latencies) * 1000
+    return {"n": len(ms), "mean": round(float(ms.mean()), 3), "p50": round(float(np.percentile(ms, 50)), 3),
+            "p99": round(float(np.percentile(ms, 99)), 3), "max": round(float(ms.max()), 3)}
+
+
+def emit(record):
+    if not METRICS_FILE:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    # one O_APPEND write per record keeps lines from concurrent workers intact
+    fd = os.open(METRICS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
@@ -2,36 +2,60 @@ import os
 import numpy as np
 from PIL import Image
 import shutil
+from instrumentation import timed, count, item
+
+# Only needed for legacy trees of raw .img patches. New runs can set
+# generate_patches.OHRC_OUTPUT_FORMAT = "png" and skip this second pass.
 
 PATCH_DIR = "D:/DL/DATA/patches/ohrc"      # root OHRC directory
 OUT_DIR = "D:/DL/DATA/patches/ohrc_png"    # output directory
 PATCH_SIZE = 512                             # fallback patch size
-os.makedirs(OUT_DIR, exist_ok=True)
-
-# -------- RECURSIVE SEARCH --------
-for root, _, files in os.walk(PATCH_DIR):
-    for file in files:
-        if file.lower().endswith(".img"):
-            base = os.path.splitext(file)[0]
-            img_path = os.path.join(root, file)
-            json_path = os.path.join(root, base + ".json")
-
-            # ---- Determine folder structure ----
-            relative_folder = os.path.relpath(root, PATCH_DIR)
-            dest_folder = os.path.join(OUT_DIR, relative_folder)
-            os.makedirs(dest_folder, exist_ok=True)
-
-            # ---- Convert .img → .png ----
-            try:
-                data = np.fromfile(img_path, dtype=np.uint8)
-                data = data.reshape((PATCH_SIZE, PATCH_SIZE))
-                Image.fromarray(data).save(os.path.join(dest_folder, base + ".png"))
-            except Exception as e:
-                print(f"❌ Failed to convert {img_path}: {e}")
-                continue
-
-            # ---- Copy matching JSON ----
-            if os.path.exists(json_path):
-                shutil.copy(json_path, os.path.join(dest_folder, base + ".json"))
-
-print("✅ All .img → .png conversion done, folder structure preserved.")
+SKIP_EXISTING = True                         # leave already converted patches alone
+
+
+def convert_patch(img_path, png_path):
+    data = np.fromfile(img_path, dtype=np.uint8)
+    side = int(np.sqrt(data.size))
+    shape = (side, side) if side * side == data.size else (PATCH_SIZE, PATCH_SIZE)
+    Image.fromarray(data.reshape(shape)).save(png_path)
+
+
+@timed("ohrc_img_to_png.convert_tree")
+def convert_tree(patch_dir, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+
+    # -------- RECURSIVE SEARCH --------
+    for root, _, files in os.walk(patch_dir):
+        for file in files:
+            if file.lower().endswith(".img"):
+                base = os.path.splitext(file)[0]
+                img_path = os.path.join(root, file)
+                json_path = os.path.join(root, base + ".json")
+
+                # ---- Determine folder structure ----
+                relative_folder = os.path.relpath(root, patch_dir)
+                dest_folder = os.path.join(out_dir, relative_folder)
+                os.makedirs(dest_folder, exist_ok=True)
+                png_path = os.path.join(dest_folder, base + ".png")
+
+                # ---- Convert .img → .png ----
+                if not (SKIP_EXISTING and os.path.exists(png_path)):
+                    try:
+                        with item():
+                            convert_patch(img_path, png_path)
+                    except Exception as e:
+                        print(f"❌ Failed to convert {img_path}: {e}")
+                        count(failed=1)
+                        continue
+                    count(patches=1, bytes=os.path.getsize(img_path))
+                else:
+                    count(skipped=1)
+
+                # ---- Copy matching JSON ----
+                if os.path.exists(json_path):
+                    shutil.copy(json_path, os.path.join(dest_folder, base + ".json"))
+
+
+if __name__ == "__main__":
+    convert_tree(PATCH_DIR, OUT_DIR)
+    print("✅ All .img → .png conversion done, folder structure preserved.")
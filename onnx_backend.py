@@ -0,0 +1,296 @@
+import os
+import ast
+import glob
+import time
+import numpy as np
+import cv2
+import onnxruntime as ort
+
+# ==============================================================
+# CONFIGURATION
+# ==============================================================
+MODEL_PATH = r"C:/Users/Amma.DESKTOP-4K4SV7F/Desktop/dl_code/runs/train/moon_detection_full_pipeline11/weights/best.pt"
+CALIB_DIR = "D:/DL/DATA/patches/ohrc_png"       # OHRC patch PNGs (searched recursively) for INT8 calibration
+BENCH_DIR = r"D:/DL/DATA/roboflow_upload_pngs"  # images used to compare the backends
+IMGSZ = 640
+CALIB_SAMPLES = 256         # patches fed through the FP32 model to collect activation ranges
+BENCH_IMAGES = 64
+BATCH_SIZE = 8              # images per ONNX Runtime run
+CONF_THRESHOLD = 0.4
+IOU_THRESHOLD = 0.7         # same default as ultralytics predict()
+MAX_DET = 300
+NUM_THREADS = 0             # ONNX Runtime intra-op threads; 0 = one per physical core
+PAD_VALUE = 114             # letterbox fill, as in ultralytics
+
+# Exports sit next to the .pt: best.onnx (FP32) and best.int8.onnx (static INT8, QDQ format).
+# The detection head's box decoding (DFL softmax, anchor arithmetic, final concat of
+# pixel boxes with 0-1 scores) stays in FP32: one shared quantisation scale over
+# both ranges wipes out the class scores.
+
+
+# ==============================================================
+# EXPORT + QUANTISATION
+# ==============================================================
+def export_onnx(weights=MODEL_PATH, imgsz=IMGSZ):
+    """FP32 ONNX export with a dynamic batch axis; reuses an export newer than the weights."""
+    onnx_path = os.path.splitext(weights)[0] + ".onnx"
+    if os.path.exists(onnx_path) and os.path.getmtime(onnx_path) >= os.path.getmtime(weights):
+        return onnx_path
+    from ultralytics import YOLO
+    return YOLO(weights).export(format="onnx", imgsz=imgsz, dynamic=True, simplify=False)
+
+
+def list_images(folder, limit=None):
+    paths = sorted(p for ext in ("png", "jpg", "jpeg", "tif")
+                   for p in glob.glob(os.path.join(folder, "**", f"*.{ext}"), recursive=True))
+    if limit and len(paths) > limit:
+        paths = [paths[i] for i in np.linspace(0, len(paths) - 1, limit).astype(int)]   # spread over all folders
+    return paths
+
+
+def head_decode_nodes(onnx_path):
+    """Names of the detection head's decoding nodes (everything in the last module except its conv branches)."""
+    import onnx
+    nodes = onnx.load(onnx_path).graph.node
+    head = max(int(n.name.split("/")[1].split(".")[1]) for n in nodes if n.name.startswith("/model."))
+    prefix = f"/model.{head}/"
+    return [n.name for n in nodes if n.name.startswith(prefix) and "/cv2." not in n.name and "/cv3." not in n.name]
+
+
+def quantize_int8(onnx_path, calib_dir=CALIB_DIR, samples=CALIB_SAMPLES, imgsz=IMGSZ):
+    """Static INT8 quantisation (per-channel weights, MinMax-calibrated activations) of an FP32 export."""
+    from onnxruntime.quantization import (quantize_static, CalibrationDataReader, QuantFormat, QuantType,
+                                          CalibrationMethod)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class CalibrationReader(CalibrationDataReader):
+        """Feeds letterboxed OHRC patches to the calibrator one at a time."""
+
+        def __init__(self, input_name, paths):
+            self.input_name = input_name
+            self.paths = iter(paths)
+
+        def get_next(self):
+            path = next(self.paths, None)
+            if path is None:
+                return None
+            blob, _ = preprocess([cv2.imread(path)], imgsz)
+            return {self.input_name: blob}
+
+    int8_path = os.path.splitext(onnx_path)[0] + ".int8.onnx"
+    if os.path.exists(int8_path) and os.path.getmtime(int8_path) >= os.path.getmtime(onnx_path):
+        return int8_path
+    paths = list_images(calib_dir, samples)
+    if not paths:
+        raise FileNotFoundError(f"No calibration images under {calib_dir}")
+
+    prep_path = os.path.splitext(onnx_path)[0] + ".prep.onnx"
+    try:
+        quant_pre_process(onnx_path, prep_path, skip_symbolic_shape=True)
+    except Exception as e:
+        print(f"⚠ Pre-processing for quantisation failed ({e}); quantising the raw export")
+        prep_path = onnx_path
+
+    input_name = ort.InferenceSession(prep_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    print(f"🧪 Calibrating INT8 model on {len(paths)} patches...")
+    start = time.perf_counter()
+    quantize_static(prep_path, int8_path, CalibrationReader(input_name, paths),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method=CalibrationMethod.MinMax,
+                    nodes_to_exclude=head_decode_nodes(prep_path))
+    if prep_path != onnx_path:
+        os.remove(prep_path)
+    print(f"✅ INT8 model written to {int8_path} ({time.perf_counter() - start:.1f}s)")
+    return int8_path
+
+
+# ==============================================================
+# PRE / POST-PROCESSING
+# ==============================================================
+def letterbox(img, imgsz=IMGSZ):
+    """Resize keeping aspect ratio and pad to imgsz x imgsz; returns (image, ratio, (pad_x, pad_y))."""
+    h, w = img.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * r)), int(round(h * r))
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    dw, dh = (imgsz - new_w) / 2, (imgsz - new_h) / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(PAD_VALUE,) * 3)
+    return img, r, (left, top)
+
+
+def preprocess(images, imgsz=IMGSZ):
+    """BGR (or grayscale) uint8 images -> (n, 3, imgsz, imgsz) float32 RGB blob + per-image scaling."""
+    blob = np.empty((len(images), 3, imgsz, imgsz), dtype=np.float32)
+    scales = []
+    for i, img in enumerate(images):
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        boxed, r, pad = letterbox(img, imgsz)
+        blob[i] = boxed[:, :, ::-1].transpose(2, 0, 1)
+        scales.append((r, pad, img.shape[:2]))
+    blob /= 255.0
+    return blob, scales
+
+
+def nms(boxes, scores, iou):
+    """Greedy NMS on xyxy boxes; returns kept indices by descending score."""
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-scores)
+    keep = []
+    while len(order):
+        i = order[0]
+        keep.append(i)
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        order = order[1:][inter / (areas[i] + areas[order[1:]] - inter + 1e-9) <= iou]
+    return np.array(keep, dtype=np.int64)
+
+
+def postprocess(output, scale, conf=CONF_THRESHOLD, iou=IOU_THRESHOLD, max_det=MAX_DET):
+    """One image's raw (4 + nc, anchors) head output -> (xyxy, conf, cls) in original pixels."""
+    pred = output.T
+    cls = pred[:, 4:].argmax(axis=1)
+    scores = pred[np.arange(len(pred)), 4 + cls]
+    mask = scores > conf
+    pred, cls, scores = pred[mask], cls[mask], scores[mask]
+
+    xy, wh = pred[:, :2], pred[:, 2:4]
+    boxes = np.concatenate([xy - wh / 2, xy + wh / 2], axis=1)
+    keep = nms(boxes + cls[:, None] * 7680.0, scores, iou)[:max_det]   # class offset = per-class NMS in one pass
+    boxes, scores, cls = boxes[keep], scores[keep], cls[keep]
+
+    r, (pad_x, pad_y), (h, w) = scale
+    boxes = (boxes - np.array([pad_x, pad_y, pad_x, pad_y], dtype=np.float32)) / r
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+    return boxes, scores, cls
+
+
+class Detections:
+    """Per-image result of OnnxDetector, as plain NumPy arrays (xywh = centre + size, in pixels)."""
+
+    def __init__(self, path, xyxy, conf, cls):
+        self.path = path
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls.astype(np.int64)
+
+    @property
+    def xywh(self):
+        return np.concatenate([(self.xyxy[:, :2] + self.xyxy[:, 2:]) / 2, self.xyxy[:, 2:] - self.xyxy[:, :2]], axis=1)
+
+    def __len__(self):
+        return len(self.conf)
+
+
+# ==============================================================
+# DETECTOR
+# ==============================================================
+class OnnxDetector:
+    def __init__(self, onnx_path, imgsz=IMGSZ, conf=CONF_THRESHOLD, iou=IOU_THRESHOLD, threads=NUM_THREADS):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        meta = self.session.get_modelmeta().custom_metadata_map
+        if meta.get("task", "detect") != "detect":
+            raise ValueError(f"{onnx_path} is a '{meta['task']}' model; the ONNX backend decodes detect heads only")
+        self.names = ast.literal_eval(meta["names"]) if "names" in meta else {}
+        self.imgsz, self.conf, self.iou = imgsz, conf, iou
+
+    def predict(self, sources, batch_size=BATCH_SIZE):
+        """Detections for image paths (or BGR arrays), run batch_size images per session call."""
+        results = []
+        for b in range(0, len(sources), batch_size):
+            chunk = sources[b:b + batch_size]
+            images = [cv2.imread(s) if isinstance(s, str) else s for s in chunk]
+            blob, scales = preprocess(images, self.imgsz)
+            outputs = self.session.run(None, {self.input_name: blob})[0]
+            for src, out, scale in zip(chunk, outputs, scales):
+                xyxy, conf, cls = postprocess(out, scale, self.conf, self.iou)
+                results.append(Detections(src if isinstance(src, str) else None, xyxy, conf, cls))
+        return results
+
+    def save_annotated(self, result, out_dir):
+        """Draw boxes + labels onto a copy of the source image, like ultralytics save=True."""
+        os.makedirs(out_dir, exist_ok=True)
+        img = cv2.imread(result.path)
+        for (x1, y1, x2, y2), conf, cls in zip(result.xyxy.astype(int), result.conf, result.cls):
+            cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            cv2.putText(img, f"{self.names.get(int(cls), cls)} {conf:.2f}", (x1, max(y1 - 4, 10)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+        cv2.imwrite(os.path.join(out_dir, os.path.basename(result.path)), img)
+
+
+def load_detector(weights=MODEL_PATH, int8=True, calib_dir=CALIB_DIR, **kwargs):
+    """Export (and optionally quantise) the weights once, then open them with ONNX Runtime."""
+    onnx_path = export_onnx(weights)
+    if int8:
+        onnx_path = quantize_int8(onnx_path, calib_dir)
+    print(f"⚙ ONNX Runtime backend: {os.path.basename(onnx_path)}")
+    return OnnxDetector(onnx_path, **kwargs)
+
+
+# ==============================================================
+# BENCHMARK
+# ==============================================================
+def timed(run, sources, batch_size):
+    """Per-batch latencies (ms per image) and overall images/s of run(list_of_paths)."""
+    run(sources[:batch_size])                              # warm-up
+    per_image, counts, start = [], [], time.perf_counter()
+    for b in range(0, len(sources), batch_size):
+        t0 = time.perf_counter()
+        counts.extend(run(sources[b:b + batch_size]))
+        per_image.append((time.perf_counter() - t0) * 1000 / len(sources[b:b + batch_size]))
+    return np.array(per_image), len(sources) / (time.perf_counter() - start), counts
+
+
+def benchmark(weights=MODEL_PATH, image_dir=BENCH_DIR, n_images=BENCH_IMAGES, batch_size=BATCH_SIZE,
+              calib_dir=CALIB_DIR):
+    """Compare PyTorch CPU, ONNX FP32 and ONNX INT8 on the same images."""
+    from ultralytics import YOLO
+    sources = list_images(image_dir, n_images)
+    if not sources:
+        print(f"⚠ No images found in {image_dir}")
+        return {}
+
+    torch_model = YOLO(weights)
+    onnx_path = export_onnx(weights)
+    fp32 = OnnxDetector(onnx_path, conf=CONF_THRESHOLD)
+    int8 = OnnxDetector(quantize_int8(onnx_path, calib_dir), conf=CONF_THRESHOLD)
+
+    def run_torch(batch):
+        return [len(r.boxes) for r in torch_model.predict(batch, imgsz=IMGSZ, conf=CONF_THRESHOLD,
+                                                          device='cpu', verbose=False)]
+
+    backends = {
+        "pytorch": run_torch,
+        "onnx_fp32": lambda batch: [len(r) for r in fp32.predict(batch, batch_size)],
+        "onnx_int8": lambda batch: [len(r) for r in int8.predict(batch, batch_size)],
+    }
+
+    report, reference = {}, None
+    print(f"\n⏱ Benchmark on {len(sources)} images (batch {batch_size}, imgsz {IMGSZ})")
+    for name, run in backends.items():
+        latencies, throughput, counts = timed(run, sources, batch_size)
+        reference = counts if reference is None else reference
+        report[name] = {"ms_per_image_mean": float(latencies.mean()), "ms_per_image_p50": float(np.percentile(latencies, 50)),
+                        "ms_per_image_p90": float(np.percentile(latencies, 90)), "images_per_s": throughput,
+                        "detections": int(sum(counts))}
+        print(f"  {name:10s} {latencies.mean():8.1f} ms/img (p50 {np.percentile(latencies, 50):.1f}, "
+              f"p90 {np.percentile(latencies, 90):.1f})  {throughput:6.1f} img/s  "
+              f"{sum(counts)} detections vs {sum(reference)} (pytorch)")
+    return report
+
+
+if __name__ == "__main__":
+    benchmark()
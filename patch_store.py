@@ -0,0 +1,131 @@
+import os
+import json
+import numpy as np
+
+# -------- SHARDED PATCH STORE --------
+# Packs a folder's patches into a few large raw shard files plus one index.json,
+# instead of one .img/.tif and one .json per patch. Patches are read back through
+# np.memmap, so get() returns a zero-copy view into the shard.
+#
+#   <store_dir>/index.json      dtype, patch shape, shard names, patch_id -> (shard, slot, meta)
+#   <store_dir>/shard_000.bin   consecutive raw patches, C order
+
+INDEX_FILE = "index.json"
+SHARD_PATCHES = 4096          # patches per shard (4096 x 512 x 512 uint8 = 1 GiB)
+
+
+def is_store(path):
+    return os.path.exists(os.path.join(path, INDEX_FILE))
+
+
+class PatchStoreWriter:
+    def __init__(self, store_dir, shard_patches=SHARD_PATCHES):
+        self.store_dir = store_dir
+        self.shard_patches = shard_patches
+        self.dtype = None
+        self.shape = None
+        self.shards = []
+        self.entries = []
+        self._fh = None
+        self._slot = 0
+        os.makedirs(store_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _next_shard(self):
+        if self._fh is not None:
+            self._fh.close()
+        name = f"shard_{len(self.shards):03d}.bin"
+        self._fh = open(os.path.join(self.store_dir, name), "wb")
+        self.shards.append(name)
+        self._slot = 0
+
+    def add(self, patch_id, patch, meta=None):
+        if self.dtype is None:
+            self.dtype, self.shape = patch.dtype, patch.shape
+        elif patch.dtype != self.dtype or patch.shape != self.shape:
+            raise ValueError(f"{patch_id}: expected {self.shape} {self.dtype}, got {patch.shape} {patch.dtype}")
+        if self._fh is None or self._slot == self.shard_patches:
+            self._next_shard()
+        self._fh.write(np.ascontiguousarray(patch).tobytes())
+        self.entries.append({"id": patch_id, "shard": len(self.shards) - 1, "slot": self._slot, "meta": meta or {}})
+        self._slot += 1
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        index = {
+            "dtype": np.dtype(self.dtype or np.uint8).str,
+            "shape": list(self.shape or ()),
+            "shards": self.shards,
+            "patches": self.entries,
+        }
+        tmp_path = os.path.join(self.store_dir, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(index, f)
+        # the index only appears once every shard is complete
+        os.replace(tmp_path, os.path.join(self.store_dir, INDEX_FILE))
+
+
+class PatchStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE), encoding='utf-8') as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index["dtype"])
+        self.shape = tuple(index["shape"])
+        self.shards = index["shards"]
+        self.entries = {e["id"]: e for e in index["patches"]}
+        self._counts = [0] * len(self.shards)
+        for e in index["patches"]:
+            self._counts[e["shard"]] += 1
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, patch_id):
+        return patch_id in self.entries
+
+    def ids(self):
+        return list(self.entries)
+
+    def _shard(self, k):
+        if k not in self._maps:
+            self._maps[k] = np.memmap(os.path.join(self.store_dir, self.shards[k]), dtype=self.dtype,
+                                      mode='r', shape=(self._counts[k],) + self.shape)
+        return self._maps[k]
+
+    def get(self, patch_id):
+        """Zero-copy view of one patch."""
+        e = self.entries[patch_id]
+        return self._shard(e["shard"])[e["slot"]]
+
+    def meta(self, patch_id):
+        return self.entries[patch_id]["meta"]
+
+    def items(self):
+        """Yield (patch_id, patch, meta) in shard order."""
+        for patch_id, e in self.entries.items():
+            yield patch_id, self._shard(e["shard"])[e["slot"]], e["meta"]
+
+
+_open_stores = {}       # per-process cache for open_store()
+
+
+def open_store(store_dir):
+    """PatchStore for store_dir, opened once per process (pool workers reuse it across tasks).
+
+    Keyed on the index's mtime, so a store rewritten in the meantime is opened afresh.
+    """
+    path = os.path.abspath(store_dir)
+    stamp = os.stat(os.path.join(path, INDEX_FILE)).st_mtime_ns
+    cached = _open_stores.get(path)
+    if cached is None or cached[0] != stamp:
+        cached = _open_stores[path] = (stamp, PatchStore(path))
+    return cached[1]
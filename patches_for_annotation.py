@@ -3,16 +3,26 @@ import json
 import shutil
 import numpy as np
 from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
 from skimage.measure import shannon_entropy
 from sklearn.preprocessing import MinMaxScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from patch_store import PatchStore, is_store, open_store, INDEX_FILE as STORE_INDEX
+from feature_cache import cached_features, file_stamp
+from patch_metadata import load_folder_metas
+from instrumentation import stage, timed, count
 
 # -------- CONFIG --------
-ROOT_DIR = "D:/DL/DATA/patches/ohrc_png"      # root folder containing OHRC subfolders
+ROOT_DIR = "D:/DL/DATA/patches/ohrc_png"      # root folder containing OHRC subfolders (PNG folders or patch stores)
 DEST_ROOT = "D:/DL/DATA/selected_patches"     # destination root
 NUM_SAMPLES_PER_FOLDER = 20                   # number of diverse patches per OHRC set
-
-os.makedirs(DEST_ROOT, exist_ok=True)
+SELECTION_MODE = "per_folder"                 # "per_folder": quota per folder, "global": one budget over all folders
+ANNOTATION_BUDGET = 500                       # patches picked across the whole corpus in "global" mode
+GLOBAL_METHOD = "minibatch_kmeans"            # "minibatch_kmeans" or "kcenter" (greedy k-center coreset)
+METADATA_DB = "D:/DL/DATA/patches/patch_metadata.sqlite"  # metadata table from generate_patches (used if present)
+FEATURE_WORKERS = os.cpu_count() or 1         # processes decoding patches for visual features
+FEATURE_CHUNK = 64                            # patches decoded and stacked per task
+FEATURE_CACHE_DIR = "D:/DL/DATA/patches/feature_cache"   # per-folder feature cache (None = always recompute)
 
 
 def extract_metadata(json_path):
@@ -20,6 +30,14 @@ def extract_metadata(json_path):
     try:
         with open(json_path, 'r', encoding='utf-8') as f:
             meta = json.load(f)
+        return metadata_features(meta)
+    except Exception:
+        return [0]*7
+
+
+def metadata_features(meta):
+    """Metadata values for diversity scoring from an already loaded metadata dict."""
+    try:
         sun_elev = meta.get("sun_elevation", 0)
         sun_azim = meta.get("sun_azimuth", 0)
         yaw = meta.get("satellite_yaw", 0)
@@ -34,40 +52,113 @@ def extract_metadata(json_path):
 
 def extract_visual_features(img_path):
     """Compute brightness, contrast, entropy."""
-    img = np.array(Image.open(img_path).convert("L"))
+    return visual_features(np.array(Image.open(img_path).convert("L")))
+
+
+def visual_features(img):
+    """Brightness, contrast, entropy of a grayscale patch array."""
     entropy = shannon_entropy(img)
     brightness = np.mean(img)
     contrast = np.std(img)
     return [brightness, contrast, entropy]
 
 
-def process_ohrc_folder(folder_path, dest_folder):
-    os.makedirs(dest_folder, exist_ok=True)
-    patches = []
+def batch_visual_features(stack):
+    """Brightness, contrast, entropy for a (n, h, w) uint8 stack, from one 256-bin histogram per patch.
 
-    # gather image + metadata features
-    for file in os.listdir(folder_path):
-        if file.endswith(".png"):
-            base = os.path.splitext(file)[0]
-            json_path = os.path.join(folder_path, base + ".json")
-            if not os.path.exists(json_path):
-                continue
+    Matches visual_features(): shannon_entropy on uint8 is the entropy of the
+    value histogram, and mean/std follow from the histogram moments.
+    """
+    flat = stack.reshape(len(stack), -1)
+    hist = np.stack([np.bincount(p, minlength=256) for p in flat]).astype(np.float64)
+    prob = hist / flat.shape[1]
+    levels = np.arange(256, dtype=np.float64)
+    brightness = prob @ levels
+    contrast = np.sqrt(np.maximum(prob @ levels ** 2 - brightness ** 2, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.nansum(np.where(prob > 0, prob * np.log2(prob), 0), axis=1)
+    return np.column_stack([brightness, contrast, entropy])
 
-            img_path = os.path.join(folder_path, file)
-            visual_feats = extract_visual_features(img_path)
-            meta_feats = extract_metadata(json_path)
-            features = visual_feats + meta_feats
-            patches.append((base, features))
 
-    print(f"📂 {os.path.basename(folder_path)} — {len(patches)} patches found")
+def _png_chunk_features(img_paths):
+    return batch_visual_features(np.stack([np.array(Image.open(p).convert("L")) for p in img_paths]))
 
-    if len(patches) == 0:
-        return
 
-    X = np.array([f for _, f in patches])
-    X_scaled = MinMaxScaler().fit_transform(X)
-    k = min(NUM_SAMPLES_PER_FOLDER, len(X_scaled))
+def _store_chunk_features(store_dir, patch_ids):
+    store = open_store(store_dir)
+    return batch_visual_features(np.stack([store.get(pid) for pid in patch_ids]).astype(np.uint8, copy=False))
+
+
+def extract_visual_features_batch(img_paths=None, store_dir=None, patch_ids=None, workers=FEATURE_WORKERS):
+    """(n, 3) visual features for PNG paths, or for patch ids of a store, decoded on a process pool."""
+    items = img_paths if store_dir is None else patch_ids
+    chunks = [items[i:i + FEATURE_CHUNK] for i in range(0, len(items), FEATURE_CHUNK)]
+    if not chunks:
+        return np.empty((0, 3))
+    if store_dir is None:
+        tasks = [(_png_chunk_features, chunk) for chunk in chunks]
+    else:
+        tasks = [(_store_chunk_features, store_dir, chunk) for chunk in chunks]
+    if workers <= 1 or len(chunks) == 1:
+        return np.vstack([fn(*args) for fn, *args in tasks])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fn, *args) for fn, *args in tasks]
+        return np.vstack([f.result() for f in futures])
+
+
+def gather_folder_features(folder_path):
+    """(patch names, (n, 10) feature matrix) for one folder of PNGs or one patch store."""
+    store = PatchStore(folder_path) if is_store(folder_path) else None
+    metas = {} if store is not None else load_folder_metas(METADATA_DB, os.path.basename(folder_path))
+
+    # list patches and the file stamps their features depend on
+    if store is not None:
+        bases = store.ids()
+        store_stamp = file_stamp(os.path.join(folder_path, STORE_INDEX))
+        stamps = [store_stamp] * len(bases)
+    else:
+        bases, img_paths, json_paths = [], [], []
+        for file in sorted(os.listdir(folder_path)):
+            if file.endswith(".png"):
+                base = os.path.splitext(file)[0]
+                json_path = os.path.join(folder_path, base + ".json")
+                if base not in metas and not os.path.exists(json_path):
+                    continue
+                bases.append(base)
+                img_paths.append(os.path.join(folder_path, file))
+                json_paths.append(json_path)
+        stamps = [file_stamp(img, js) for img, js in zip(img_paths, json_paths)]
 
+    # gather image + metadata features, only for patches the cache does not cover
+    def compute(indices):
+        if store is not None:
+            visual = extract_visual_features_batch(store_dir=folder_path, patch_ids=[bases[i] for i in indices])
+            meta_feats = [metadata_features(store.meta(bases[i])) for i in indices]
+        else:
+            visual = extract_visual_features_batch([img_paths[i] for i in indices])
+            meta_feats = [metadata_features(metas[bases[i]]) if bases[i] in metas else extract_metadata(json_paths[i])
+                          for i in indices]
+        return np.hstack([visual, np.array(meta_feats, dtype=np.float64).reshape(len(indices), -1)])
+
+    cache_path = os.path.join(FEATURE_CACHE_DIR, os.path.basename(folder_path) + ".npz") if FEATURE_CACHE_DIR else None
+    with stage("patches_for_annotation.features", folder=os.path.basename(folder_path)) as st:
+        X, cached = cached_features(cache_path, bases, stamps, compute)
+        st.count(patches=len(bases), cached=cached)
+    if X is None:
+        X = np.empty((0, 10))
+    print(f"📂 {os.path.basename(folder_path)} — {len(bases)} patches found ({cached} features cached)")
+    return bases, X
+
+
+def nearest_to_centres(X, labels, centres):
+    """Index of the point closest to its cluster centre, for every non-empty cluster."""
+    dists = np.linalg.norm(X - centres[labels], axis=1)
+    order = np.lexsort((dists, labels))
+    first = np.r_[True, labels[order][1:] != labels[order][:-1]]
+    return order[first]
+
+
+def select_kmeans(X_scaled, k):
     kmeans = KMeans(n_clusters=k, random_state=42)
     labels = kmeans.fit_predict(X_scaled)
 
@@ -78,13 +169,42 @@ def process_ohrc_folder(folder_path, dest_folder):
         cluster_points = X_scaled[indices]
         centroid = kmeans.cluster_centers_[cluster_id]
         dists = np.linalg.norm(cluster_points - centroid, axis=1)
-        best_idx = indices[np.argmin(dists)]
-        selected.append(patches[best_idx][0])
+        selected.append(indices[np.argmin(dists)])
+    return selected
 
-    print(f"✅ Selected {len(selected)} diverse patches from {os.path.basename(folder_path)}")
 
-    # copy selected files (preserving patch names)
+def select_minibatch_kmeans(X_scaled, k):
+    kmeans = MiniBatchKMeans(n_clusters=k, random_state=42, batch_size=4096, n_init=3)
+    labels = kmeans.fit_predict(X_scaled)
+    return list(nearest_to_centres(X_scaled, labels, kmeans.cluster_centers_))
+
+
+def select_kcenter(X_scaled, k):
+    """Greedy k-center coreset: repeatedly take the point farthest from everything picked so far."""
+    first = int(np.argmin(np.linalg.norm(X_scaled - X_scaled.mean(axis=0), axis=1)))
+    selected = [first]
+    min_dist = np.linalg.norm(X_scaled - X_scaled[first], axis=1)
+    while len(selected) < k:
+        pick = int(np.argmax(min_dist))
+        if min_dist[pick] == 0:
+            break   # everything left is an exact duplicate of a picked patch
+        selected.append(pick)
+        min_dist = np.minimum(min_dist, np.linalg.norm(X_scaled - X_scaled[pick], axis=1))
+    return selected
+
+
+def copy_selected(folder_path, dest_folder, selected):
+    """Copy the selected patches of one folder (preserving patch names) into dest_folder."""
+    os.makedirs(dest_folder, exist_ok=True)
+    store = PatchStore(folder_path) if is_store(folder_path) else None
+    metas = {} if store is not None else load_folder_metas(METADATA_DB, os.path.basename(folder_path))
+
     for base in selected:
+        if store is not None:
+            Image.fromarray(np.asarray(store.get(base))).save(os.path.join(dest_folder, base + ".png"))
+            with open(os.path.join(dest_folder, base + ".json"), "w", encoding='utf-8') as jf:
+                json.dump(store.meta(base), jf, indent=2)
+            continue
         png_src = os.path.join(folder_path, base + ".png")
         json_src = os.path.join(folder_path, base + ".json")
         png_dst = os.path.join(dest_folder, base + ".png")
@@ -92,16 +212,75 @@ def process_ohrc_folder(folder_path, dest_folder):
         shutil.copy(png_src, png_dst)
         if os.path.exists(json_src):
             shutil.copy(json_src, json_dst)
+        elif base in metas:
+            with open(json_dst, "w", encoding='utf-8') as jf:
+                json.dump(metas[base], jf, indent=2)
 
     print(f"📁 Saved to {dest_folder}\n")
 
+
+@timed("patches_for_annotation.select_folder")
+def process_ohrc_folder(folder_path, dest_folder):
+    bases, X = gather_folder_features(folder_path)
+    if len(bases) == 0:
+        return
+
+    X_scaled = MinMaxScaler().fit_transform(X)
+    k = min(NUM_SAMPLES_PER_FOLDER, len(X_scaled))
+    selected = [bases[i] for i in select_kmeans(X_scaled, k)]
+    count(patches=len(bases), selected=len(selected))
+
+    print(f"✅ Selected {len(selected)} diverse patches from {os.path.basename(folder_path)}")
+    copy_selected(folder_path, dest_folder, selected)
+
+
+@timed("patches_for_annotation.select_global")
+def select_global(folders, budget=ANNOTATION_BUDGET, method=GLOBAL_METHOD):
+    """Pick `budget` patches across all folders at once; returns {folder_path: [patch names]}.
+
+    Folders are streamed one at a time and only their feature rows are kept, so
+    memory grows by ten floats per patch. Because lon/lat are features, overlapping
+    strips that show the same ground fall into the same cluster and are picked once.
+    """
+    scaler = MinMaxScaler()
+    owners, names, blocks = [], [], []
+    for folder_path in folders:
+        bases, X = gather_folder_features(folder_path)
+        if len(bases) == 0:
+            continue
+        scaler.partial_fit(X)
+        owners.extend([folder_path] * len(bases))
+        names.extend(bases)
+        blocks.append(X.astype(np.float32))
+    if not blocks:
+        return {}
+
+    X_scaled = scaler.transform(np.vstack(blocks)).astype(np.float32)
+    k = min(budget, len(X_scaled))
+    picks = select_kcenter(X_scaled, k) if method == "kcenter" else select_minibatch_kmeans(X_scaled, k)
+
+    selection = {}
+    for i in picks:
+        selection.setdefault(owners[i], []).append(names[i])
+    count(patches=len(X_scaled), selected=len(picks))
+    print(f"✅ Selected {len(picks)} diverse patches from {len(X_scaled)} across {len(blocks)} folders")
+    return selection
+
 # -------- MAIN --------
 
 
-for subfolder in os.listdir(ROOT_DIR):
-    folder_path = os.path.join(ROOT_DIR, subfolder)
-    if os.path.isdir(folder_path):
-        dest_folder = os.path.join(DEST_ROOT, subfolder)
-        process_ohrc_folder(folder_path, dest_folder)
+if __name__ == "__main__":
+    os.makedirs(DEST_ROOT, exist_ok=True)
+
+    folders = [os.path.join(ROOT_DIR, d) for d in sorted(os.listdir(ROOT_DIR))
+               if os.path.isdir(os.path.join(ROOT_DIR, d))]
+
+    if SELECTION_MODE == "global":
+        for folder_path, selected in select_global(folders).items():
+            copy_selected(folder_path, os.path.join(DEST_ROOT, os.path.basename(folder_path)), selected)
+    else:
+        for folder_path in folders:
+            dest_folder = os.path.join(DEST_ROOT, os.path.basename(folder_path))
+            process_ohrc_folder(folder_path, dest_folder)
 
-print("🎉 Done! All diverse samples saved by subfolder.")
+    print("🎉 Done! All diverse samples saved by subfolder.")
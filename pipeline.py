@@ -0,0 +1,319 @@
+import os
+import ast
+import sys
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import extra_data_added
+import generate_patches
+import build_overviews
+import ohrc_img_to_png
+import patches_for_annotation
+import roboflow_png
+from patch_metadata import open_table
+from instrumentation import stage
+
+# ==============================================================
+# CONFIGURATION
+# ==============================================================
+STATE_FILE = "D:/DL/DATA/pipeline_state.json"    # fingerprint of every stage unit that last ran successfully
+ENABLED_STAGES = ["ingest", "generate_patches", "overviews", "ohrc_img_to_png", "select_patches", "roboflow_png",
+                  "unannotated_images"]          # add "training" to retrain when the Roboflow export changes
+FORCE_STAGES = []           # stages to rerun even when their fingerprints match
+NUM_WORKERS = generate_patches.NUM_WORKERS        # folders of one stage processed at once
+DRY_RUN = False             # only print what would run
+
+# The pipeline as a dependency graph. Every stage is split into units (one per
+# folder where the stage works per folder, otherwise a single "all" unit). A
+# unit's fingerprint hashes its own inputs -- file sizes/mtimes for raw data,
+# the fingerprints of the upstream units it reads otherwise -- plus the config
+# that shapes its output. A unit reruns when its fingerprint differs from the
+# one recorded after its last successful run, or when its outputs are missing.
+# Stages run in order; the changed units of a stage run concurrently.
+
+
+# ==============================================================
+# FINGERPRINTS
+# ==============================================================
+def digest(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def tree_fingerprint(path):
+    """Hash of (relative path, size, mtime) of every file under path; cheap, nothing is read."""
+    if not os.path.exists(path):
+        return "missing"
+    if os.path.isfile(path):
+        st = os.stat(path)
+        return digest(st.st_size, st.st_mtime_ns)
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            st = os.stat(os.path.join(root, file))
+            entries.append((os.path.relpath(os.path.join(root, file), path), st.st_size, st.st_mtime_ns))
+    return digest(entries)
+
+
+def script_constant(script, name):
+    """Value of a literal assignment `NAME = ...` anywhere in a script, without running it."""
+    with open(script, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == name for t in node.targets):
+            try:
+                return ast.literal_eval(node.value)
+            except ValueError:
+                return None
+    return None
+
+
+def script_path(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def input_folders(input_dir, formats):
+    """(folder_path, folder_name) of every ohr_/tmc_/dtm_ product folder."""
+    folders = []
+    for fmt in formats:
+        folder_root = os.path.join(input_dir, fmt)
+        if os.path.isdir(folder_root):
+            folders.extend((os.path.join(folder_root, f), f) for f in sorted(os.listdir(folder_root))
+                           if os.path.isdir(os.path.join(folder_root, f)))
+    return folders
+
+
+def load_state():
+    if not os.path.exists(STATE_FILE):
+        return {}
+    with open(STATE_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(state):
+    os.makedirs(os.path.dirname(os.path.abspath(STATE_FILE)), exist_ok=True)
+    tmp_path = STATE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, STATE_FILE)
+
+
+# ==============================================================
+# UNIT JOBS (top-level so they can run on the process pool)
+# ==============================================================
+def run_ingest():
+    for target in (extra_data_added.TARGET_OHRC, extra_data_added.TARGET_TMC, extra_data_added.TARGET_DTM):
+        os.makedirs(target, exist_ok=True)
+    extra_data_added.stream_new_sources()
+
+
+def run_generate(folder_path, folder_name):
+    # the input changed: drop the old patches (files and metadata rows) so no stale tile survives
+    patch_dir = os.path.join(generate_patches.OUTPUT_DIR, folder_name)
+    if os.path.isdir(patch_dir):
+        shutil.rmtree(patch_dir)
+    table = open_table(os.path.join(generate_patches.OUTPUT_DIR, generate_patches.METADATA_DB)) \
+        if generate_patches.METADATA_DB else None
+    if table is not None:
+        with table:
+            table.delete_folder(folder_name)
+    os.makedirs(generate_patches.OUTPUT_DIR, exist_ok=True)
+    generate_patches.run_folder(folder_path, folder_name)
+
+
+def run_overviews(folder_path, folder_name):
+    os.makedirs(build_overviews.OUTPUT_DIR, exist_ok=True)
+    build_overviews.run_folder(folder_path, folder_name)
+
+
+def run_png(folder_name):
+    out_dir = os.path.join(ohrc_img_to_png.OUT_DIR, folder_name)
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    ohrc_img_to_png.convert_tree(os.path.join(generate_patches.OUTPUT_DIR, folder_name), out_dir)
+
+
+def run_select_folder(source_root, folder_name):
+    dest_folder = os.path.join(patches_for_annotation.DEST_ROOT, folder_name)
+    if os.path.isdir(dest_folder):
+        shutil.rmtree(dest_folder)
+    patches_for_annotation.process_ohrc_folder(os.path.join(source_root, folder_name), dest_folder)
+
+
+def run_select_global(source_root, folder_names):
+    pfa = patches_for_annotation
+    if os.path.isdir(pfa.DEST_ROOT):
+        shutil.rmtree(pfa.DEST_ROOT)
+    selection = pfa.select_global([os.path.join(source_root, name) for name in folder_names])
+    for folder_path, selected in selection.items():
+        pfa.copy_selected(folder_path, os.path.join(pfa.DEST_ROOT, os.path.basename(folder_path)), selected)
+
+
+def run_roboflow_png():
+    if os.path.isdir(roboflow_png.DEST_DIR):
+        shutil.rmtree(roboflow_png.DEST_DIR)
+    roboflow_png.copy_pngs()
+
+
+def run_script(name):
+    """Scripts that work at import time (training, inference) run in their own interpreter."""
+    subprocess.run([sys.executable, script_path(name)], check=True, cwd=os.path.dirname(script_path(name)))
+
+
+# ==============================================================
+# STAGES: upstream fingerprints -> {unit: (fingerprint, outputs, job)}
+# ==============================================================
+def ingest_units(upstream):
+    raw = extra_data_added.RAW_ZIP_DIR
+    return {"all": (digest(tree_fingerprint(raw)), [extra_data_added.TARGET_OHRC], (run_ingest,))}
+
+
+def generate_units(upstream):
+    gp = generate_patches
+    config = digest(gp.PATCH_SIZE, gp.OUTPUT_BACKEND, gp.OHRC_OUTPUT_FORMAT, gp.WRITE_JSON, gp.METADATA_DB,
+                    gp.REJECT_RULES, gp.OHRC_NODATA)
+    return {folder: (digest(tree_fingerprint(folder_path), config),
+                     [os.path.join(gp.OUTPUT_DIR, folder, gp.DONE_MARKER)],
+                     (run_generate, folder_path, folder))
+            for folder_path, folder in input_folders(gp.INPUT_DIR, gp.FORMATS)}
+
+
+def overview_units(upstream):
+    bo = build_overviews
+    config = digest(bo.TILE, bo.MAX_LEVELS, bo.PREVIEW_SIDE)
+    return {folder: (digest(tree_fingerprint(folder_path), config),
+                     [os.path.join(bo.OUTPUT_DIR, folder, bo.INDEX_FILE)],
+                     (run_overviews, folder_path, folder))
+            for folder_path, folder in input_folders(bo.INPUT_DIR, bo.FORMATS)}
+
+
+def png_units(upstream):
+    gp = generate_patches
+    if gp.OUTPUT_BACKEND != "files" or gp.OHRC_OUTPUT_FORMAT != "img":
+        return {}       # patches are already PNGs (or shards); nothing to convert
+    return {folder: (digest(fp), [os.path.join(ohrc_img_to_png.OUT_DIR, folder)], (run_png, folder))
+            for folder, fp in upstream["generate_patches"].items() if "ohr" in folder}
+
+
+def select_source_root():
+    """Where the OHRC patches selection reads live: converted PNGs, or generate_patches' own output."""
+    gp = generate_patches
+    if gp.OUTPUT_BACKEND == "files" and gp.OHRC_OUTPUT_FORMAT == "img":
+        return ohrc_img_to_png.OUT_DIR
+    if gp.OUTPUT_BACKEND == "files" and gp.OHRC_OUTPUT_FORMAT.lower() != "png":
+        raise ValueError(f"select_patches reads PNG patches or patch stores; OHRC_OUTPUT_FORMAT="
+                         f"{gp.OHRC_OUTPUT_FORMAT!r} gives neither (use 'img', 'png' or the shards backend)")
+    return gp.OUTPUT_DIR
+
+
+def select_units(upstream):
+    pfa = patches_for_annotation
+    root = select_source_root()
+    source = upstream.get("ohrc_img_to_png") or {f: fp for f, fp in upstream["generate_patches"].items() if "ohr" in f}
+    if pfa.SELECTION_MODE == "global":
+        fp = digest(source, root, pfa.ANNOTATION_BUDGET, pfa.GLOBAL_METHOD)
+        return {"all": (fp, [pfa.DEST_ROOT], (run_select_global, root, sorted(source)))}
+    return {folder: (digest(fp, root, pfa.NUM_SAMPLES_PER_FOLDER), [os.path.join(pfa.DEST_ROOT, folder)],
+                     (run_select_folder, root, folder))
+            for folder, fp in source.items()}
+
+
+def roboflow_units(upstream):
+    return {"all": (digest(upstream["select_patches"]), [roboflow_png.DEST_DIR], (run_roboflow_png,))}
+
+
+def training_units(upstream):
+    script = script_path("training_code.py")
+    data_yaml = script_constant(script, "DATA_YAML")
+    fp = digest(tree_fingerprint(os.path.dirname(data_yaml)) if data_yaml else None, tree_fingerprint(script))
+    return {"all": (fp, [], (run_script, "training_code.py"))}
+
+
+def unannotated_units(upstream):
+    script = script_path("unannotated_images.py")
+    weights = script_constant(script, "MODEL_PATH")
+    fp = digest(upstream.get("roboflow_png"), upstream.get("training"),
+                tree_fingerprint(weights) if weights else None, tree_fingerprint(script))
+    return {"all": (fp, [], (run_script, "unannotated_images.py"))}
+
+
+# (name, upstream stages, units, run units concurrently)
+STAGES = [
+    ("ingest", [], ingest_units, False),
+    ("generate_patches", ["ingest"], generate_units, True),     # ingest only decides which folders exist
+    ("overviews", ["ingest"], overview_units, True),
+    ("ohrc_img_to_png", ["generate_patches"], png_units, True),
+    ("select_patches", ["generate_patches", "ohrc_img_to_png"], select_units, False),   # feature extraction is already a process pool
+    ("roboflow_png", ["select_patches"], roboflow_units, False),
+    ("training", [], training_units, False),
+    ("unannotated_images", ["roboflow_png", "training"], unannotated_units, False),
+]
+
+
+# ==============================================================
+# RUNNER
+# ==============================================================
+def run_units(name, jobs, parallel, state):
+    """Run the changed units of one stage, recording each in the state as soon as it succeeds."""
+    done = 0
+    with stage(f"pipeline.{name}", units=len(jobs)) as st:
+        if parallel and NUM_WORKERS > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+                futures = {pool.submit(*job): (unit, fp) for unit, (fp, job) in jobs.items()}
+                for future in as_completed(futures):
+                    unit, fp = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"❌ {name}[{unit}] failed: {e}")
+                        continue
+                    state.setdefault(name, {})[unit] = fp
+                    save_state(state)
+                    done += 1
+        else:
+            for unit, (fp, job) in jobs.items():
+                try:
+                    job[0](*job[1:])
+                except Exception as e:
+                    print(f"❌ {name}[{unit}] failed: {e}")
+                    continue
+                state.setdefault(name, {})[unit] = fp
+                save_state(state)
+                done += 1
+        st.count(units=done, failed=len(jobs) - done)
+    return done == len(jobs)
+
+
+def run_pipeline(enabled=ENABLED_STAGES, force=FORCE_STAGES, dry_run=DRY_RUN):
+    if "select_patches" in enabled:
+        select_source_root()    # refuse a patch format selection cannot read before any stage runs
+    state = load_state()
+    fingerprints = {}       # this run's unit fingerprints, fed downstream
+    for name, deps, units_fn, parallel in STAGES:
+        if name not in enabled:
+            continue
+        units = units_fn({dep: fingerprints[dep] for dep in deps if dep in fingerprints})
+        fingerprints[name] = {unit: fp for unit, (fp, _, _) in units.items()}
+        recorded = state.get(name, {})
+        jobs = {unit: (fp, job) for unit, (fp, outputs, job) in units.items()
+                if name in force or recorded.get(unit) != fp or not all(os.path.exists(p) for p in outputs)}
+
+        print(f"\n🔗 {name}: {len(jobs)} of {len(units)} units to run")
+        if not jobs or dry_run:
+            for unit in sorted(jobs):
+                print(f"   would run {name}[{unit}]")
+            continue
+        start = time.perf_counter()
+        if not run_units(name, jobs, parallel, state):
+            print(f"⚠ {name} had failures; downstream stages are skipped until it succeeds")
+            return False
+        print(f"✅ {name} done in {time.perf_counter() - start:.1f}s")
+    return True
+
+
+if __name__ == "__main__":
+    run_pipeline()
+    print("\n🎉 Pipeline up to date.")
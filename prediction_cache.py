@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+import sqlite3
+import numpy as np
+
+# -------- DETECTION CACHE --------
+# SQLite store of detections keyed by (image content hash, model key). The model
+# key hashes the weights file together with every inference parameter that
+# changes the output (backend, conf, image size, ...), so retraining or a new
+# threshold invalidates everything without any manual cleanup. File hashes are
+# remembered per (path, size, mtime) so unchanged files are not re-read.
+# Detections are stored as one float32 blob of (n, 6) rows: x, y, w, h, conf, cls.
+
+HASH_BUFFER = 1 << 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, sha256 TEXT);
+CREATE TABLE IF NOT EXISTS detections (
+    image_hash TEXT, model_key TEXT, n INTEGER, boxes BLOB,
+    PRIMARY KEY (image_hash, model_key));
+"""
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_BUFFER):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    def __init__(self, db_path, weights_path, **params):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        key = json.dumps({"weights": self.file_hash(weights_path), **params}, sort_keys=True)
+        self.model_key = hashlib.sha256(key.encode()).hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def file_hash(self, path):
+        """Content hash of a file, re-read only when its size or mtime changed."""
+        st = os.stat(path)
+        row = self.conn.execute("SELECT size, mtime, sha256 FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+            return row[2]
+        digest = sha256_file(path)
+        self.conn.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                          (path, st.st_size, st.st_mtime_ns, digest))
+        return digest
+
+    def lookup(self, paths):
+        """({path: (n, 6) array} for cached images, [paths that still need inference])."""
+        hashes = {path: self.file_hash(path) for path in paths}
+        self.conn.commit()
+        found = {}
+        for path, digest in hashes.items():
+            row = self.conn.execute("SELECT n, boxes FROM detections WHERE image_hash = ? AND model_key = ?",
+                                    (digest, self.model_key)).fetchone()
+            if row is not None:
+                found[path] = np.frombuffer(row[1], dtype=np.float32).reshape(row[0], 6)
+        return found, [p for p in paths if p not in found]
+
+    def store(self, detections):
+        """Save {path: (n, 6) array} for this model key in one transaction."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?)",
+            [(self.file_hash(path), self.model_key, len(boxes), np.ascontiguousarray(boxes, dtype=np.float32).tobytes())
+             for path, boxes in detections.items()])
+        self.conn.commit()
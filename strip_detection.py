@@ -0,0 +1,140 @@
+import os
+import csv
+import time
+import numpy as np
+import torch
+from torchvision.ops import batched_nms
+from ultralytics import YOLO
+from generate_patches import get_img_size_from_metadata, load_csv_coords
+from geolocation import GeoGrid
+from instrumentation import stage
+
+# ==============================================================
+# CONFIGURATION
+# ==============================================================
+MODEL_PATH = r"C:/Users/Amma.DESKTOP-4K4SV7F/Desktop/dl_code/runs/train/moon_detection_full_pipeline11/weights/best.pt"
+OHRC_DIR = r"D:/DL/DATA/lunasurface_data/ohrc"          # ohr_XXX folders with image.img + meta.xml
+STRIP_FOLDERS = []                                       # e.g. ["ohr_004"]; empty = every folder
+OUTPUT_DIR = r"D:/DL/DATA/runs/detect/strip_detections"  # one <folder>_detections.csv per strip
+TILE = 512              # tile side in strip pixels (the patch scale the model was trained on)
+OVERLAP = 128           # pixels shared by neighbouring tiles, so border objects appear whole in one tile
+IMGSZ = 640             # model input size
+BATCH_SIZE = 16         # tiles per CPU forward pass
+CONF_THRESHOLD = 0.4
+NMS_IOU = 0.5           # IoU above which overlapping detections of one class are merged across tiles
+
+CSV_FIELDS = ["folder", "class_id", "class_name", "x_center", "y_center", "width", "height",
+              "confidence", "longitude", "latitude"]
+
+# ==============================================================
+# TILING
+# ==============================================================
+
+
+def tile_starts(length):
+    """Tile offsets along one axis; the last tile is pulled back to end exactly at the edge."""
+    if length <= TILE:
+        return [0]
+    stride = TILE - OVERLAP
+    starts = list(range(0, length - TILE + 1, stride))
+    if starts[-1] != length - TILE:
+        starts.append(length - TILE)
+    return starts
+
+
+def iter_tiles(img_path, width, height):
+    """Yield (x0, y0, tile) over image.img, mapping one TILE-row band at a time."""
+    for y0 in tile_starts(height):
+        rows = min(TILE, height - y0)
+        band = np.memmap(img_path, dtype=np.uint8, mode='r', offset=y0 * width, shape=(rows, width))
+        for x0 in tile_starts(width):
+            tile = np.zeros((TILE, TILE), dtype=np.uint8)      # pads strips narrower than a tile
+            part = band[:, x0:x0 + TILE]
+            tile[:part.shape[0], :part.shape[1]] = part
+            yield x0, y0, np.repeat(tile[:, :, None], 3, axis=2)
+        del band
+
+
+def detect_batch(model, tiles):
+    """Run one batch of tiles; returns (n, 6) [x1, y1, x2, y2, conf, cls] in strip pixels."""
+    results = model.predict([t for _, _, t in tiles], imgsz=IMGSZ, conf=CONF_THRESHOLD,
+                            device='cpu', verbose=False)
+    found = []
+    for (x0, y0, _), result in zip(tiles, results):
+        boxes = result.boxes if result.boxes is not None else result.obb
+        if boxes is None or len(boxes) == 0:
+            continue
+        xyxy = boxes.xyxy.cpu().numpy() + np.array([x0, y0, x0, y0], dtype=np.float32)
+        found.append(np.column_stack([xyxy, boxes.conf.cpu().numpy(), boxes.cls.cpu().numpy()]))
+    return found
+
+
+def global_nms(detections):
+    """Merge duplicates from overlapping tiles with class-aware NMS over the whole strip."""
+    if len(detections) == 0:
+        return detections
+    det = torch.from_numpy(detections)
+    keep = batched_nms(det[:, :4], det[:, 4], det[:, 5].long(), NMS_IOU)
+    return detections[keep.numpy()]
+
+
+def scan_strip(model, folder_path):
+    """Detect objects over a full OHRC strip without writing any patch files."""
+    img_path = os.path.join(folder_path, "image.img")
+    size = get_img_size_from_metadata(folder_path)
+    if not os.path.exists(img_path) or not size:
+        print(f"⚠ Skipping {folder_path} (image.img or meta.xml size missing)")
+        return None
+    width, height = size
+    n_expected = len(tile_starts(width)) * len(tile_starts(height))
+
+    found, batch, n_tiles = [], [], 0
+    with stage("strip_detection.scan", folder=os.path.basename(folder_path)) as st:
+        for tile in iter_tiles(img_path, width, height):
+            batch.append(tile)
+            if len(batch) == BATCH_SIZE or n_tiles + len(batch) == n_expected:
+                start = time.perf_counter()
+                found.extend(detect_batch(model, batch))
+                st.add_latency(time.perf_counter() - start, len(batch))
+                n_tiles += len(batch)
+                batch = []
+        st.count(tiles=n_tiles, bytes=width * height)
+
+    raw = np.vstack(found).astype(np.float32) if found else np.empty((0, 6), dtype=np.float32)
+    merged = global_nms(raw)
+    print(f"🧩 {os.path.basename(folder_path)}: {n_tiles} tiles, {len(raw)} raw → {len(merged)} after global NMS")
+    return merged
+
+
+def write_detections(folder_path, detections, names, csv_path):
+    geo = GeoGrid.from_coords_map(load_csv_coords(folder_path))
+    xc = (detections[:, 0] + detections[:, 2]) / 2
+    yc = (detections[:, 1] + detections[:, 3]) / 2
+    lon, lat = geo.lookup(xc, yc) if geo else (np.full(len(xc), np.nan), np.full(len(xc), np.nan))
+
+    with open(csv_path, "w", newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDS)
+        for d, x, y, lo, la in zip(detections, xc, yc, lon, lat):
+            writer.writerow([os.path.basename(folder_path), int(d[5]), names[int(d[5])],
+                             round(float(x), 2), round(float(y), 2), round(float(d[2] - d[0]), 2),
+                             round(float(d[3] - d[1]), 2), round(float(d[4]), 4),
+                             "" if np.isnan(lo) else float(lo), "" if np.isnan(la) else float(la)])
+
+
+if __name__ == "__main__":
+    model = YOLO(MODEL_PATH)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    folders = STRIP_FOLDERS or sorted(d for d in os.listdir(OHRC_DIR) if os.path.isdir(os.path.join(OHRC_DIR, d)))
+
+    for folder in folders:
+        start = time.perf_counter()
+        folder_path = os.path.join(OHRC_DIR, folder)
+        detections = scan_strip(model, folder_path)
+        if detections is None:
+            continue
+        csv_path = os.path.join(OUTPUT_DIR, f"{folder}_detections.csv")
+        write_detections(folder_path, detections, model.names, csv_path)
+        print(f"📄 {folder}: {len(detections)} detections → {csv_path} ({time.perf_counter() - start:.1f}s)")
+
+    print("\n🎉 Strip-level detection complete!")
@@ -0,0 +1,77 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# -------- VECTORIZED TILING --------
+# A band of rows is viewed as a (rows, cols, size, size) block array through
+# strides, so no pixel is copied to cut tiles. Statistics for every tile of the
+# band come out of a few whole-array operations on a strided subsample:
+#   valid_fraction      share of pixels that are not no-data (nodata value or NaN)
+#   std                 standard deviation of the valid pixels
+#   entropy             Shannon entropy (bits) of a 256-level histogram of the valid pixels;
+#                       uint8 uses the values directly, other dtypes the tile's own min-max range
+#   saturated_fraction  share of valid pixels at the integer dtype's maximum (0 for floats)
+# reject_reasons() turns them into a reason per tile ("" = keep).
+
+STATS_STEP = 4      # sample every 4th pixel per axis for the statistics (1 = every pixel)
+
+
+def tile_blocks(band, size):
+    """Zero-copy (rows, cols, size, size) view of the full tiles of a 2-D array; partial edges are left out."""
+    band = np.asarray(band)
+    rows, cols = band.shape[0] // size, band.shape[1] // size
+    s0, s1 = band.strides
+    return as_strided(band, shape=(rows, cols, size, size), strides=(s0 * size, s1 * size, s0, s1), writeable=False)
+
+
+def tile_stats(blocks, nodata=None, step=STATS_STEP):
+    """Per-tile statistics of a block array, each as a (rows, cols) array."""
+    rows, cols = blocks.shape[:2]
+    sub = blocks[:, :, ::step, ::step]
+    values = sub.astype(np.float32)
+    valid = ~np.isnan(values) if np.issubdtype(sub.dtype, np.floating) else np.ones(values.shape, dtype=bool)
+    if nodata is not None:
+        valid &= values != nodata
+    n = valid.sum(axis=(2, 3))
+    safe_n = np.maximum(n, 1)
+
+    filled = np.where(valid, values, 0)
+    mean = filled.sum(axis=(2, 3)) / safe_n
+    var = np.where(valid, (values - mean[:, :, None, None]) ** 2, 0).sum(axis=(2, 3)) / safe_n
+
+    if sub.dtype == np.uint8:
+        levels = sub
+    else:
+        lo = np.where(valid, values, np.inf).min(axis=(2, 3))[:, :, None, None]
+        hi = np.where(valid, values, -np.inf).max(axis=(2, 3))[:, :, None, None]
+        span = np.where(np.isfinite(hi - lo) & (hi > lo), hi - lo, 1)
+        levels = np.clip(np.nan_to_num((values - np.where(np.isfinite(lo), lo, 0)) * (255.0 / span)), 0, 255)
+        levels = levels.astype(np.uint8)
+    # one bincount over (tile, level) pairs gives every tile's histogram at once
+    tile_ids = np.arange(rows * cols, dtype=np.int64).reshape(rows, cols, 1, 1) * 256
+    hist = np.bincount((tile_ids + levels).ravel(), weights=valid.ravel(),
+                       minlength=rows * cols * 256).reshape(rows, cols, 256)
+    p = hist / safe_n[:, :, None]
+    entropy = 0.0 - (p * np.log2(np.where(p > 0, p, 1))).sum(axis=2)
+
+    if np.issubdtype(sub.dtype, np.integer):
+        saturated = ((values == np.iinfo(sub.dtype).max) & valid).sum(axis=(2, 3)) / safe_n
+    else:
+        saturated = np.zeros((rows, cols))
+
+    return {"valid_fraction": n / (sub.shape[2] * sub.shape[3]),
+            "std": np.sqrt(var), "entropy": entropy, "saturated_fraction": saturated}
+
+
+def reject_reasons(stats, min_valid=None, min_std=None, min_entropy=None, max_saturated=None):
+    """(rows, cols) array of rejection reasons, "" for tiles that pass every threshold (None = not checked)."""
+    reasons = np.full(stats["std"].shape, "", dtype=object)
+    # checked in reverse priority so the most basic failure is the one recorded
+    if max_saturated is not None:
+        reasons[stats["saturated_fraction"] > max_saturated] = "saturated"
+    if min_entropy is not None:
+        reasons[stats["entropy"] < min_entropy] = "low_entropy"
+    if min_std is not None:
+        reasons[stats["std"] < min_std] = "featureless"
+    if min_valid is not None:
+        reasons[stats["valid_fraction"] < min_valid] = "nodata"
+    return reasons
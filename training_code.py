@@ -10,6 +10,11 @@ def main():
     DATA_YAML = r"D:/DL/DATA/moon_ohrc_detection.v2i.yolov8-obb/data.yaml"  # Roboflow dataset YAML
     MODEL_NAME = "yolov8m.pt"                   # Detection model
     RUN_NAME = "moon_detection_full_pipeline"
+    PREDICT_BACKEND = "pytorch"                 # steps 4-5: "pytorch" or "onnx" (ONNX Runtime, CPU)
+    ONNX_INT8 = True                            # onnx: statically quantised INT8 model
+    CALIB_DIR = "D:/DL/DATA/patches/ohrc_png"   # onnx: OHRC patches for INT8 calibration
+    TRAIN_FROM_SHARDS = False                   # read pre-decoded dataset_shards instead of decoding JPEGs every epoch
+    SHARD_DIR = "D:/DL/DATA/dataset_shards"     # shards: where the per-split patch stores are built
 
     # Confirm CUDA (GPU) availability
     device = 0 if torch.cuda.is_available() else 'cpu'
@@ -20,9 +25,17 @@ def main():
     # =====================================================================
     model = YOLO(MODEL_NAME)
 
+    trainer = None
+    if TRAIN_FROM_SHARDS:
+        from dataset_shards import build_shards, ShardTrainer
+        build_shards(DATA_YAML, SHARD_DIR)      # only splits whose export changed are repacked
+        ShardTrainer.shard_dir = SHARD_DIR
+        trainer = ShardTrainer
+
     print("\n📌 Starting training...")
     results = model.train(
         data=DATA_YAML,
+        trainer=trainer,
         epochs=200,          # Increase for better convergence
         imgsz=640,           # Resize images
         batch=8,             # Adjust for GPU VRAM
@@ -44,6 +57,11 @@ def main():
     )
     print("\n✅ Training complete! Check runs/train for results & weights.\n")
 
+    detector = None
+    if PREDICT_BACKEND == "onnx":
+        from onnx_backend import load_detector, list_images
+        detector = load_detector(str(model.trainer.best), int8=ONNX_INT8, calib_dir=CALIB_DIR, conf=0.5)
+
     # =====================================================================
     # 2. VALIDATION METRICS
     # =====================================================================
@@ -90,7 +108,10 @@ def main():
     print("\n🔍 Running inference on one sample test image...")
     TEST_IMG = r"D:/DL/DATA/moon_ohrc_detection.v2i.yolov8-obb/test/images/ohr_000_patch_3676_png.rf.1df89fcc93addd79b5597a697bfdf0d1.jpg"
 
-    if os.path.exists(TEST_IMG):
+    if os.path.exists(TEST_IMG) and detector is not None:
+        detector.save_annotated(detector.predict([TEST_IMG])[0], "runs/detect/predict_onnx")
+        print("✅ Single-image inference done! Check 'runs/detect/predict_onnx/' for output.")
+    elif os.path.exists(TEST_IMG):
         single_pred = model.predict(
             source=TEST_IMG,
             conf=0.5,
@@ -108,7 +129,12 @@ def main():
     print("\n🧠 Running inference on all test images...")
     TEST_DIR = r"D:/DL/DATA/moon_ohrc_detection.v2i.yolov8-obb/test/images"
 
-    if os.path.exists(TEST_DIR):
+    if os.path.exists(TEST_DIR) and detector is not None:
+        for result in detector.predict(list_images(TEST_DIR)):
+            detector.save_annotated(result, "runs/detect/predict_onnx")
+        print("✅ Inference complete for all test images!")
+        print("📂 Check 'runs/detect/predict_onnx/' for output.")
+    elif os.path.exists(TEST_DIR):
         all_preds = model.predict(
             source=TEST_DIR,
             conf=0.5,
@@ -1,7 +1,12 @@
 from ultralytics import YOLO
+from ultralytics.data.utils import IMG_FORMATS
 import os
+import csv
+import time
 import torch
+import numpy as np
 import pandas as pd
+from instrumentation import stage
 
 # ==============================================================
 # CONFIGURATION
@@ -11,6 +16,21 @@ UNANNOTATED_DIR = r"D:/DL/DATA/roboflow_upload_pngs"
 OUTPUT_DIR = r"D:/DL/DATA/runs/detect/unannotated_predictions"
 CSV_OUTPUT = os.path.join(OUTPUT_DIR, "predictions.csv")
 CONF_THRESHOLD = 0.4
+IMGSZ = 640
+STREAM_MODE = True          # True: batched, incremental, resumable; False: one predict() call, CSV at the end
+OUTPUT_FORMAT = "csv"       # streaming output: "csv" (appended to CSV_OUTPUT) or "parquet" (part files, needs pyarrow)
+PARQUET_DIR = os.path.join(OUTPUT_DIR, "predictions_parquet")
+PROCESSED_LOG = os.path.join(OUTPUT_DIR, "processed_images.txt")   # images whose detections are on disk
+BATCH_SIZE = 64             # images handed to predict() at a time
+FLUSH_EVERY = 512           # images between flushes of detections + processed log
+SAVE_ANNOTATED = True       # also save annotated images & YOLO .txt files like the original run
+BACKEND = "pytorch"         # "pytorch" (ultralytics) or "onnx" (ONNX Runtime on CPU, see onnx_backend.py; always streams)
+ONNX_INT8 = True            # onnx backend: use the statically quantised INT8 model
+ONNX_CALIB_DIR = "D:/DL/DATA/patches/ohrc_png"   # OHRC patches used to calibrate the INT8 model
+ANNOTATED_DIR = os.path.join("runs/detect", "unannotated_predictions")
+PREDICTION_CACHE = os.path.join(OUTPUT_DIR, "prediction_cache.sqlite")   # None disables; see prediction_cache.py
+
+CSV_FIELDS = ["image", "class_id", "class_name", "x_center", "y_center", "width", "height", "confidence"]
 
 device = 0 if torch.cuda.is_available() else 'cpu'
 print(f"🚀 Using device: {device}")
@@ -18,13 +38,181 @@ print(f"🚀 Using device: {device}")
 # ==============================================================
 # LOAD MODEL
 # ==============================================================
-model = YOLO(MODEL_PATH)
+if BACKEND == "onnx":
+    from onnx_backend import load_detector
+    model = load_detector(MODEL_PATH, int8=ONNX_INT8, calib_dir=ONNX_CALIB_DIR, conf=CONF_THRESHOLD, imgsz=IMGSZ)
+else:
+    model = YOLO(MODEL_PATH)
+
+
+def detection_arrays(result):
+    """(n, 6) float32 [x_center, y_center, width, height, conf, cls] in pixels for either backend."""
+    if BACKEND == "onnx":
+        boxes, confs, classes = result.xywh, result.conf, result.cls
+    elif result.boxes is None:
+        return np.empty((0, 6), dtype=np.float32)
+    else:
+        boxes = result.boxes.xywh.cpu().numpy()        # x, y, w, h (pixels)
+        confs = result.boxes.conf.cpu().numpy()        # confidence scores
+        classes = result.boxes.cls.cpu().numpy()       # class indices
+    return np.column_stack([boxes, confs, classes]).astype(np.float32).reshape(-1, 6)
+
+
+def rows_for(image_name, detections):
+    """One CSV row per detection of an image."""
+    return [{
+        "image": image_name,
+        "class_id": int(d[5]),
+        "class_name": model.names[int(d[5])],
+        "x_center": float(d[0]),
+        "y_center": float(d[1]),
+        "width": float(d[2]),
+        "height": float(d[3]),
+        "confidence": float(d[4])
+    } for d in detections]
+
+
+def detection_rows(result):
+    return rows_for(os.path.basename(result.path), detection_arrays(result))
+
+
+# ==============================================================
+# STREAMING HELPERS
+# ==============================================================
+def list_images(folder):
+    return sorted(f for f in os.listdir(folder) if f.rsplit(".", 1)[-1].lower() in IMG_FORMATS)
+
+
+def load_processed():
+    if not os.path.exists(PROCESSED_LOG):
+        return set()
+    with open(PROCESSED_LOG, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def drop_unlogged_rows(processed):
+    """Remove CSV rows of images written after the last processed-log flush (a crash mid-flush)."""
+    if OUTPUT_FORMAT != "csv" or not os.path.exists(CSV_OUTPUT):
+        return
+    # filtered row by row into a temp file, so a large CSV is never held in memory
+    tmp_path = CSV_OUTPUT + ".tmp"
+    dropped = 0
+    with open(CSV_OUTPUT, newline='', encoding="utf-8") as src, open(tmp_path, "w", newline='', encoding="utf-8") as dst:
+        writer = csv.DictWriter(dst, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for row in csv.DictReader(src):
+            if row["image"] in processed:
+                writer.writerow(row)
+            else:
+                dropped += 1
+    if not dropped:
+        os.remove(tmp_path)
+        return
+    os.replace(tmp_path, CSV_OUTPUT)
+    print(f"🧹 Dropped {dropped} rows of images not marked as processed")
+
+
+def flush(rows, images, part):
+    """Write pending detections, then mark their images as processed."""
+    if OUTPUT_FORMAT == "parquet":
+        if rows:
+            os.makedirs(PARQUET_DIR, exist_ok=True)
+            pd.DataFrame(rows, columns=CSV_FIELDS).to_parquet(os.path.join(PARQUET_DIR, f"part_{part:05d}.parquet"),
+                                                              index=False)
+    else:
+        new_file = not os.path.exists(CSV_OUTPUT)
+        with open(CSV_OUTPUT, "a", newline='', encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+    with open(PROCESSED_LOG, "a", encoding="utf-8") as f:
+        f.writelines(name + "\n" for name in images)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def predict_batch(paths):
+    if BACKEND == "onnx":
+        results = model.predict(paths)
+        if SAVE_ANNOTATED:
+            for result in results:
+                model.save_annotated(result, ANNOTATED_DIR)
+        return results
+    # stream=True yields one Results at a time, so only the current image is held in memory
+    return model.predict(source=paths, conf=CONF_THRESHOLD, imgsz=IMGSZ, stream=True, save=SAVE_ANNOTATED,
+                         save_txt=SAVE_ANNOTATED, project="runs/detect", name="unannotated_predictions",
+                         exist_ok=True, device=device, verbose=False)
+
+
+def reset_outputs():
+    """Start the CSV/parquet output and processed log from scratch."""
+    for path in (CSV_OUTPUT, PROCESSED_LOG):
+        if os.path.exists(path):
+            os.remove(path)
+    if os.path.isdir(PARQUET_DIR):
+        for f in os.listdir(PARQUET_DIR):
+            os.remove(os.path.join(PARQUET_DIR, f))
+
+
+def open_cache():
+    from prediction_cache import PredictionCache
+    return PredictionCache(PREDICTION_CACHE, MODEL_PATH, backend=BACKEND, int8=ONNX_INT8 and BACKEND == "onnx",
+                           conf=CONF_THRESHOLD, imgsz=IMGSZ)
+
+
+def stream_predictions():
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    cache = open_cache() if PREDICTION_CACHE else None
+    if cache is not None:
+        # every image is written again; the cache means only new or changed ones reach the model
+        reset_outputs()
+    processed = load_processed()
+    drop_unlogged_rows(processed)
+    todo = [f for f in list_images(UNANNOTATED_DIR) if f not in processed]
+    print(f"📂 {len(todo)} images to process ({len(processed)} already done) in: {UNANNOTATED_DIR}")
+
+    part = len(os.listdir(PARQUET_DIR)) if os.path.isdir(PARQUET_DIR) else 0
+    rows, images, total, inferred = [], [], 0, 0
+    with stage("unannotated_images.predict", backend=BACKEND, batch_size=BATCH_SIZE) as st:
+        for b in range(0, len(todo), BATCH_SIZE):
+            batch = [os.path.join(UNANNOTATED_DIR, f) for f in todo[b:b + BATCH_SIZE]]
+            detections, missing = cache.lookup(batch) if cache is not None else ({}, batch)
+            if missing:
+                start = time.perf_counter()
+                fresh = {result.path: detection_arrays(result) for result in predict_batch(missing)}
+                st.add_latency(time.perf_counter() - start, len(missing))
+                if cache is not None:
+                    cache.store(fresh)
+                detections.update(fresh)
+                inferred += len(missing)
+            for path in batch:
+                rows.extend(rows_for(os.path.basename(path), detections[path]))
+                images.append(os.path.basename(path))
+            st.count(images=len(batch), inferred=len(missing), detections=sum(len(detections[p]) for p in batch),
+                     bytes=sum(os.path.getsize(p) for p in batch))
+
+            if len(images) >= FLUSH_EVERY or b + BATCH_SIZE >= len(todo):
+                flush(rows, images, part)
+                total += len(images)
+                part += 1
+                print(f"💾 {total}/{len(todo)} images flushed ({inferred} run through the model)")
+                rows, images = [], []
+    if cache is not None:
+        cache.close()
+
 
 # ==============================================================
 # RUN INFERENCE
 # ==============================================================
 if not os.path.exists(UNANNOTATED_DIR):
     print(f"⚠ Directory not found: {UNANNOTATED_DIR}")
+elif STREAM_MODE or BACKEND == "onnx":
+    stream_predictions()
+    target = PARQUET_DIR if OUTPUT_FORMAT == "parquet" else CSV_OUTPUT
+    print(f"\n✅ Inference complete! Detections saved to: {target}")
 else:
     print(f"📂 Running inference on all images in: {UNANNOTATED_DIR}")
 
@@ -47,27 +235,7 @@ else:
     all_detections = []
 
     for result in results:
-        image_path = result.path
-        image_name = os.path.basename(image_path)
-
-        if result.boxes is None:
-            continue
-
-        boxes = result.boxes.xywh.cpu().numpy()        # x, y, w, h (normalized)
-        confs = result.boxes.conf.cpu().numpy()        # confidence scores
-        classes = result.boxes.cls.cpu().numpy()       # class indices
-
-        for box, conf, cls in zip(boxes, confs, classes):
-            all_detections.append({
-                "image": image_name,
-                "class_id": int(cls),
-                "class_name": model.names[int(cls)],
-                "x_center": box[0],
-                "y_center": box[1],
-                "width": box[2],
-                "height": box[3],
-                "confidence": float(conf)
-            })
+        all_detections.extend(detection_rows(result))
 
     # Create DataFrame and save
     df = pd.DataFrame(all_detections)
@@ -75,4 +243,4 @@ else:
     df.to_csv(CSV_OUTPUT, index=False)
 
     print(f"📄 Saved detailed predictions to: {CSV_OUTPUT}")
-    print(f"🖼 Annotated images & YOLO .txt files are in: {OUTPUT_DIR}")
\ No newline at end of file
+    print(f"🖼 Annotated images & YOLO .txt files are in: {OUTPUT_DIR}")
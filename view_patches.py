@@ -1,64 +1,355 @@
 import os
 import glob
+import html
 import json
+import math
 import numpy as np
 import matplotlib.pyplot as plt
 import rasterio
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+from patch_store import PatchStore, is_store, open_store, INDEX_FILE as STORE_INDEX
+from patch_metadata import load_folder_metas
+from feature_cache import file_stamp
+from instrumentation import stage
 
 # -------- CONFIG --------
 PATCH_FOLDER = "D:/DL/DATA/patches/ohrc/ohr_004"  # 👈 Change this
 PATCH_SIZE = 512
+METADATA_DB = "D:/DL/DATA/patches/patch_metadata.sqlite"  # metadata table from generate_patches (used if present)
 
-# -------- DETECT PATCH TYPE --------
-if any(fname.endswith(".img") for fname in os.listdir(PATCH_FOLDER)):
-    EXT = ".img"
-    IS_RAW = True
-else:
-    EXT = ".tif"
-    IS_RAW = False
-
-# -------- LOAD PATCHES --------
-patch_paths = sorted(glob.glob(os.path.join(PATCH_FOLDER, f"*{EXT}")))[:1000]
-
-for patch_path in patch_paths:
-    patch_id = os.path.splitext(os.path.basename(patch_path))[0]
-    json_path = os.path.join(PATCH_FOLDER, patch_id + ".json")
-
-    # -------- LOAD IMAGE --------
-    try:
-        if IS_RAW:
-            # Read raw .img as 512x512 uint8
-            image = np.fromfile(patch_path, dtype=np.uint8).reshape((PATCH_SIZE, PATCH_SIZE))
-        else:
-            with rasterio.open(patch_path) as src:
-                image = src.read(1)
-    except Exception as e:
-        print(f"❌ Failed to read {patch_path}: {e}")
-        continue
-
-    # -------- LOAD METADATA --------
-    meta = {}
-    if os.path.exists(json_path):
-        with open(json_path) as jf:
-            meta = json.load(jf)
-
-    # -------- DISPLAY --------
-    plt.figure(figsize=(6, 6))
-    plt.imshow(image, cmap='gray', vmin=np.percentile(image, 2), vmax=np.percentile(image, 98), interpolation='none')
-    plt.title(patch_id, fontsize=10)
-    plt.axis("off")
-
-    # -------- OVERLAY METADATA --------
-    overlay = ""
+MAX_PATCHES = 1000
+VIEW_MODE = "browser"       # "browser": paged contact sheets in one window, "sheets": write PNG + HTML sheets
+                            # (headless), "single": one figure per patch
+THUMB_SIZE = 160            # thumbnail side in pixels
+SHEET_COLS, SHEET_ROWS = 8, 5                              # thumbnails per contact sheet page
+THUMB_CACHE_DIR = "D:/DL/DATA/patches/thumb_cache"        # per-folder .npz of stretched thumbnails (None = no cache)
+THUMB_WORKERS = os.cpu_count() or 1                        # processes decoding + stretching patches
+SHEET_DIR = "D:/DL/DATA/patches/contact_sheets"           # "sheets" mode output (one subfolder per patch folder)
+
+CAPTION_LINES = 4           # patch id, lat/lon, sun, attitude
+CAPTION_LINE_H = 12
+
+
+# -------- PATCH SOURCES --------
+def read_patch(patch_path):
+    if patch_path.endswith(".img"):
+        # Read raw .img as 512x512 uint8
+        return np.fromfile(patch_path, dtype=np.uint8).reshape((PATCH_SIZE, PATCH_SIZE))
+    if patch_path.endswith(".png"):
+        return np.array(Image.open(patch_path).convert("L"))
+    with rasterio.open(patch_path) as src:
+        return src.read(1)
+
+
+def list_folder_patches(folder):
+    """Sorted patch paths of a per-patch .img/.png/.tif folder."""
+    # -------- DETECT PATCH TYPE --------
+    names = os.listdir(folder)
+    ext = next((e for e in (".img", ".png") if any(fname.endswith(e) for fname in names)), ".tif")
+    return sorted(glob.glob(os.path.join(folder, f"*{ext}")))
+
+
+def load_json_meta(folder, patch_id):
+    json_path = os.path.join(folder, patch_id + ".json")
+    if not os.path.exists(json_path):
+        return {}
+    with open(json_path) as jf:
+        return json.load(jf)
+
+
+def iter_folder_patches(folder):
+    """Yield (patch_id, image, meta) from a per-patch .img/.tif folder."""
+    metas = load_folder_metas(METADATA_DB, os.path.basename(os.path.normpath(folder)))
+
+    for patch_path in list_folder_patches(folder):
+        patch_id = os.path.splitext(os.path.basename(patch_path))[0]
+
+        # -------- LOAD IMAGE --------
+        try:
+            image = read_patch(patch_path)
+        except Exception as e:
+            print(f"❌ Failed to read {patch_path}: {e}")
+            continue
+
+        # -------- LOAD METADATA --------
+        yield patch_id, image, metas.get(patch_id) or load_json_meta(folder, patch_id)
+
+
+def iter_patches(folder):
+    """Patches from a shard store (read in place) or from a per-patch folder."""
+    if is_store(folder):
+        store = PatchStore(folder)
+        return ((pid, store.get(pid), store.meta(pid)) for pid in sorted(store.ids()))
+    return iter_folder_patches(folder)
+
+
+def caption(meta):
+    """Overlay lines for a patch: lat/lon, sun and attitude (whatever the metadata has)."""
+    def fmt(v):
+        return f"{v:.2f}" if isinstance(v, float) else str(v)
+
+    lines = []
     if "latitude" in meta and "longitude" in meta:
-        overlay += f"Lat: {meta['latitude']:.4f}, Lon: {meta['longitude']:.4f}\n"
+        lines.append(f"Lat {meta['latitude']:.4f}  Lon {meta['longitude']:.4f}")
     if "sun_elevation" in meta:
-        overlay += f"☀️ Sun: {meta['sun_elevation']}°, Azim: {meta.get('sun_azimuth', '?')}°\n"
+        lines.append(f"Sun {fmt(meta['sun_elevation'])}  Az {fmt(meta.get('sun_azimuth', '?'))}")
     if "satellite_yaw" in meta:
-        overlay += f"🛰️ Yaw: {meta['satellite_yaw']} | Roll: {meta['satellite_roll']} | Pitch: {meta['satellite_pitch']}"
+        lines.append(f"Y {fmt(meta['satellite_yaw'])} R {fmt(meta['satellite_roll'])} "
+                     f"P {fmt(meta['satellite_pitch'])}")
+    return lines
+
+
+# -------- THUMBNAILS --------
+def stretch_thumbnail(image):
+    """2/98 percentile stretch to uint8, shrunk onto a THUMB_SIZE square (aspect kept, black padding)."""
+    image = np.asarray(image, dtype=np.float32)
+    # percentiles of every 4th pixel per axis are indistinguishable from the full patch at thumbnail scale
+    lo, hi = np.percentile(image[::4, ::4], (2, 98))
+    stretched = np.clip((image - lo) * (255.0 / max(hi - lo, 1e-6)), 0, 255).astype(np.uint8)
+    h, w = stretched.shape
+    scale = THUMB_SIZE / max(h, w)
+    small = np.asarray(Image.fromarray(stretched).resize((max(1, round(w * scale)), max(1, round(h * scale))),
+                                                         Image.BOX))
+    thumb = np.zeros((THUMB_SIZE, THUMB_SIZE), dtype=np.uint8)
+    thumb[:small.shape[0], :small.shape[1]] = small
+    return thumb
+
+
+def _path_chunk_thumbs(patch_paths):
+    thumbs = []
+    for path in patch_paths:
+        try:
+            thumbs.append(stretch_thumbnail(read_patch(path)))
+        except Exception as e:
+            print(f"❌ Failed to read {path}: {e}")
+            thumbs.append(np.zeros((THUMB_SIZE, THUMB_SIZE), dtype=np.uint8))
+    return np.stack(thumbs)
+
+
+def _store_chunk_thumbs(store_dir, patch_ids):
+    store = open_store(store_dir)      # one open store per pool worker, not per chunk
+    return np.stack([stretch_thumbnail(store.get(pid)) for pid in patch_ids])
+
+
+class ThumbnailSet:
+    """Thumbnails + captions of one patch folder or store, built lazily and cached on disk.
+
+    Only the thumbnails a page needs are decoded (on a process pool kept open for
+    the whole session); every newly built batch is merged into the folder's
+    cache, keyed by the patch's file stamp, so a later session starts instantly.
+    """
+
+    def __init__(self, folder, limit=MAX_PATCHES):
+        self.folder = folder
+        self.name = os.path.basename(os.path.normpath(folder))
+        self.store = PatchStore(folder) if is_store(folder) else None
+        if self.store is not None:
+            self.ids = sorted(self.store.ids())[:limit]
+            self.paths = None
+            store_stamp = file_stamp(os.path.join(folder, STORE_INDEX))
+            self.stamps = [store_stamp] * len(self.ids)
+            self.metas = {}
+        else:
+            self.paths = list_folder_patches(folder)[:limit]
+            self.ids = [os.path.splitext(os.path.basename(p))[0] for p in self.paths]
+            self.stamps = [file_stamp(p) for p in self.paths]
+            self.metas = load_folder_metas(METADATA_DB, self.name)
+
+        self.cache_path = (os.path.join(THUMB_CACHE_DIR, f"{self.name}_{THUMB_SIZE}.npz")
+                           if THUMB_CACHE_DIR else None)
+        self.thumbs = {}        # index -> thumbnail, for this listing
+        cached = self._load_cache()
+        for i, (pid, stamp) in enumerate(zip(self.ids, self.stamps)):
+            entry = cached.get(pid)
+            if entry is not None and entry[0] == tuple(stamp):
+                self.thumbs[i] = entry[1]
+        self._pool = None
 
-    if overlay:
-        plt.gcf().text(0.05, 0.05, overlay, fontsize=8, color='yellow', bbox=dict(facecolor='black', alpha=0.5))
+    def __len__(self):
+        return len(self.ids)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with np.load(self.cache_path, allow_pickle=False) as data:
+                return {pid: (tuple(stamp), thumb)
+                        for pid, stamp, thumb in zip(data["ids"], data["stamps"], data["thumbs"])}
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable thumbnail cache {self.cache_path}: {e}")
+            return {}
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        # keep entries of patches outside this listing (e.g. beyond MAX_PATCHES) that are still current
+        known = self._load_cache()
+        for i, thumb in self.thumbs.items():
+            known[self.ids[i]] = (tuple(self.stamps[i]), thumb)
+        os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
+        tmp_path = self.cache_path + ".tmp.npz"
+        np.savez(tmp_path, ids=np.array(list(known), dtype=str),
+                 stamps=np.array([s for s, _ in known.values()], dtype=np.int64).reshape(len(known), -1),
+                 thumbs=np.stack([t for _, t in known.values()]))
+        os.replace(tmp_path, self.cache_path)
+
+    def build(self, indices):
+        """Make sure the thumbnails of these indices exist, decoding the missing ones in parallel."""
+        missing = [i for i in indices if i not in self.thumbs]
+        if not missing:
+            return
+        with stage("view_patches.thumbnails", folder=self.name) as st:
+            workers = max(1, min(THUMB_WORKERS, len(missing)))
+            size = math.ceil(len(missing) / workers)
+            chunks = [missing[k:k + size] for k in range(0, len(missing), size)]
+            if self.store is not None:
+                tasks = [(_store_chunk_thumbs, self.folder, [self.ids[i] for i in chunk]) for chunk in chunks]
+            else:
+                tasks = [(_path_chunk_thumbs, [self.paths[i] for i in chunk]) for chunk in chunks]
+            if workers == 1:
+                results = [fn(*args) for fn, *args in tasks]
+            else:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=THUMB_WORKERS)
+                results = [f.result() for f in [self._pool.submit(fn, *args) for fn, *args in tasks]]
+            for chunk, thumbs in zip(chunks, results):
+                self.thumbs.update(zip(chunk, thumbs))
+            st.count(patches=len(missing), cached=len(indices) - len(missing))
+        self._save_cache()
+
+    def meta(self, i):
+        if self.store is not None:
+            return self.store.meta(self.ids[i])
+        return self.metas.get(self.ids[i]) or load_json_meta(self.folder, self.ids[i])
+
+
+# -------- CONTACT SHEETS --------
+def page_count(n):
+    return max(1, math.ceil(n / (SHEET_COLS * SHEET_ROWS)))
+
+
+def page_indices(n, page):
+    per_page = SHEET_COLS * SHEET_ROWS
+    return list(range(page * per_page, min(n, (page + 1) * per_page)))
+
+
+def fit_text(draw, text, font, width):
+    while text and draw.textlength(text, font=font) > width:
+        text = text[:-1]
+    return text
+
+
+def render_sheet(thumbs, page):
+    """One page as an RGB mosaic: thumbnails with patch id + metadata captions underneath."""
+    indices = page_indices(len(thumbs), page)
+    thumbs.build(indices)
+    cell_w, cell_h = THUMB_SIZE + 4, THUMB_SIZE + 4 + CAPTION_LINES * CAPTION_LINE_H
+    sheet = Image.new("RGB", (SHEET_COLS * cell_w, SHEET_ROWS * cell_h), "black")
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default()
+    for slot, i in enumerate(indices):
+        x, y = (slot % SHEET_COLS) * cell_w + 2, (slot // SHEET_COLS) * cell_h + 2
+        sheet.paste(Image.fromarray(thumbs.thumbs[i]).convert("RGB"), (x, y))
+        for k, line in enumerate(([thumbs.ids[i]] + caption(thumbs.meta(i)))[:CAPTION_LINES]):
+            draw.text((x, y + THUMB_SIZE + 1 + k * CAPTION_LINE_H), fit_text(draw, line, font, THUMB_SIZE),
+                      fill="yellow" if k else "white", font=font)
+    return sheet
+
+
+def browse(thumbs):
+    """Single window; → / n / space for the next page, ← / p for the previous one."""
+    pages = page_count(len(thumbs))
+    state = {"page": 0}
+    fig, ax = plt.subplots(figsize=(SHEET_COLS * 1.9, SHEET_ROWS * 2.3))
+    ax.axis("off")
+    shown = ax.imshow(render_sheet(thumbs, 0), interpolation='none')
+
+    def set_title():
+        ax.set_title(f"{thumbs.name} — page {state['page'] + 1}/{pages} ({len(thumbs)} patches)", fontsize=10)
+
+    def show(page):
+        state["page"] = page % pages
+        shown.set_data(render_sheet(thumbs, state["page"]))
+        set_title()
+        fig.canvas.draw_idle()
+
+    def on_key(event):
+        if event.key in ("right", "n", " "):
+            show(state["page"] + 1)
+        elif event.key in ("left", "p"):
+            show(state["page"] - 1)
+
+    fig.canvas.mpl_connect("key_press_event", on_key)
+    set_title()     # page 0 is already rendered above
     plt.tight_layout()
     plt.show()
+
+
+def write_sheets(thumbs, out_dir):
+    """Every page as sheet_NNN.png plus an index.html with per-patch captions, for headless review."""
+    os.makedirs(out_dir, exist_ok=True)
+    thumbs.build(range(len(thumbs)))        # all at once: one parallel pass
+    pages = page_count(len(thumbs))
+    parts = [f"<html><head><meta charset='utf-8'><title>{html.escape(thumbs.name)}</title></head>"
+             f"<body style='background:#111;color:#ddd;font-family:sans-serif'>"
+             f"<h1>{html.escape(thumbs.name)} — {len(thumbs)} patches</h1>"]
+    for page in range(pages):
+        name = f"sheet_{page:03d}.png"
+        render_sheet(thumbs, page).save(os.path.join(out_dir, name), compress_level=1)   # zlib dominates otherwise
+        rows = "".join(f"<tr><td>{html.escape(thumbs.ids[i])}</td><td>{html.escape(' | '.join(caption(thumbs.meta(i))))}"
+                       f"</td></tr>" for i in page_indices(len(thumbs), page))
+        parts.append(f"<h2>Page {page + 1}/{pages}</h2><img src='{name}'>"
+                     f"<details><summary>Patches</summary><table>{rows}</table></details>")
+    parts.append("</body></html>")
+    with open(os.path.join(out_dir, "index.html"), "w", encoding='utf-8') as f:
+        f.write("\n".join(parts))
+    print(f"🖼️ {pages} contact sheets for {len(thumbs)} patches → {out_dir}")
+
+
+def show_single(folder):
+    for patch_id, image, meta in islice(iter_patches(folder), MAX_PATCHES):
+        # -------- DISPLAY --------
+        plt.figure(figsize=(6, 6))
+        plt.imshow(image, cmap='gray', vmin=np.percentile(image, 2), vmax=np.percentile(image, 98),
+                   interpolation='none')
+        plt.title(patch_id, fontsize=10)
+        plt.axis("off")
+
+        # -------- OVERLAY METADATA --------
+        overlay = ""
+        if "latitude" in meta and "longitude" in meta:
+            overlay += f"Lat: {meta['latitude']:.4f}, Lon: {meta['longitude']:.4f}\n"
+        if "sun_elevation" in meta:
+            overlay += f"☀️ Sun: {meta['sun_elevation']}°, Azim: {meta.get('sun_azimuth', '?')}°\n"
+        if "satellite_yaw" in meta:
+            overlay += f"🛰️ Yaw: {meta['satellite_yaw']} | Roll: {meta['satellite_roll']} | Pitch: {meta['satellite_pitch']}"
+
+        if overlay:
+            plt.gcf().text(0.05, 0.05, overlay, fontsize=8, color='yellow', bbox=dict(facecolor='black', alpha=0.5))
+
+        plt.tight_layout()
+        plt.show()
+
+
+if __name__ == "__main__":
+    if VIEW_MODE == "single":
+        show_single(PATCH_FOLDER)
+    else:
+        with ThumbnailSet(PATCH_FOLDER) as thumbs:
+            if VIEW_MODE == "sheets":
+                write_sheets(thumbs, os.path.join(SHEET_DIR, thumbs.name))
+            else:
+                browse(thumbs)
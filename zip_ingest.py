@@ -0,0 +1,168 @@
+import os
+import hashlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from organize import extract_timestamp
+
+# -------- STREAMING SELECTIVE INGEST --------
+# Reads each ZIP's central directory, classifies members with the same name rules
+# as organize.py, and streams only the needed members straight into their final
+# ohr_XXX / tmc_XXX / dtm_XXX folder. Nothing is written to EXTRACTED_DIR.
+# Already-unzipped folders in RAW_ZIP_DIR are handled the same way.
+
+INGEST_WORKERS = 4          # archives copied in parallel
+COPY_BUFFER = 1 << 20       # bytes per read while streaming a member
+
+# OHRC metadata: (extension, required path part, target name) -- first match wins
+OHRC_META_RULES = [
+    ('.xml', 'data', "meta.xml"),
+    ('.csv', 'geometry', "coords.csv"),
+    ('.xml', 'geometry', "coords.xml"),
+    ('.spm', None, "sun.spm"),
+    ('.oat', None, "orbit.oat"),
+]
+
+
+def list_sources(raw_dir, skip=()):
+    """ZIP archives and already-unzipped folders in raw_dir, minus names in skip."""
+    sources = []
+    for item in sorted(os.listdir(raw_dir)):
+        path = os.path.join(raw_dir, item)
+        if item in skip:
+            print(f"⏩ Already ingested: {item}")
+        elif item.endswith(".zip") or os.path.isdir(path):
+            sources.append(path)
+    return sources
+
+
+def scan_source(source):
+    """(member, root, file) for every file in a ZIP or folder; root mirrors the extracted layout."""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    entries = []
+    if source.endswith(".zip"):
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                folder, file = os.path.split(info.filename)
+                entries.append((info.filename, os.path.join(stem, folder), file))
+    else:
+        for root, _, files in os.walk(source):
+            for file in files:
+                path = os.path.join(root, file)
+                entries.append((path, os.path.join(stem, os.path.relpath(root, source)), file))
+    return entries
+
+
+def classify(root, file):
+    """(kind, timestamp, target) for a member, or None when organize.py would not use it."""
+    lower = file.lower()
+    timestamp = extract_timestamp(file)
+    if not timestamp:
+        return None
+
+    if 'tmc' in lower and 'oth' in lower and file.endswith('.tif'):
+        return 'tmc', timestamp, "image.tif"
+    if 'tmc' in lower and ('dtm' in lower or 'dem' in lower) and file.endswith('.tif'):
+        return 'dtm', timestamp, "image.tif"
+    if 'tmc' in lower and file.endswith('.xml'):
+        # TMC and DTM labels share a timestamp; the product token in the stem tells them apart
+        stem = os.path.splitext(lower)[0] + '_'
+        if '_oth_' in stem:
+            return 'tmc_meta', timestamp, "meta.xml"
+        if '_dtm_' in stem or '_dem_' in stem:
+            return 'dtm_meta', timestamp, "meta.xml"
+        return None
+    if 'ohr' in lower and lower.endswith('.img'):
+        return 'ohr', timestamp, "image.img"
+    if 'ohr' in lower:
+        for ext, part, target in OHRC_META_RULES:
+            if file.endswith(ext) and (part is None or part in root):
+                return 'ohr_meta', timestamp, target
+    return None
+
+
+def classify_entries(scanned):
+    """Group {source: entries} into {(kind, timestamp): [(source, member, target)]}."""
+    found = {}
+    for source, entries in scanned.items():
+        for member, root, file in entries:
+            label = classify(root, file)
+            if label:
+                kind, timestamp, target = label
+                found.setdefault((kind, timestamp), []).append((source, member, target))
+    return found
+
+
+def plan_copies(found, target_ohrc, target_tmc, target_dtm, ohrc_start=0, pair_start=0, known_ohrc=None,
+                known_pairs=None):
+    """Turn classified members into copy jobs {source: [(member, dest)]} plus (pairs, ohrc) counts.
+
+    known_ohrc / known_pairs map timestamps of OHRC folders and TMC/DTM folder pairs from
+    earlier drops to their folders, so files arriving (or changing) later still land next
+    to their image. Callers passing them must already have dropped members whose
+    destination is taken.
+    """
+    known_ohrc = known_ohrc or {}
+    known_pairs = known_pairs or {}
+    jobs = {}
+
+    def add(dest_folder, source, member, target):
+        jobs.setdefault(source, []).append((member, os.path.join(dest_folder, target)))
+
+    # TMC + DTM pairs share one index; each label goes next to the product its stem names
+    tmc_ts = {ts for kind, ts in found if kind == 'tmc'}
+    dtm_ts = {ts for kind, ts in found if kind == 'dtm'}
+    matched_ts = sorted((tmc_ts & dtm_ts) - set(known_pairs))
+    pair_folders = dict(known_pairs)
+    for idx, ts in enumerate(matched_ts, start=pair_start):
+        pair_folders[ts] = (os.path.join(target_tmc, f"tmc_{idx:03d}"), os.path.join(target_dtm, f"dtm_{idx:03d}"))
+    for ts, (tmc_folder, dtm_folder) in pair_folders.items():
+        for folder, kinds in ((tmc_folder, ('tmc', 'tmc_meta')), (dtm_folder, ('dtm', 'dtm_meta'))):
+            for kind in kinds:
+                if (kind, ts) in found:
+                    add(folder, *found[(kind, ts)][0])
+
+    # OHRC: one folder per image timestamp, metadata joined on the same timestamp
+    ohr_ts = sorted(ts for kind, ts in found if kind == 'ohr' and ts not in known_ohrc)
+    ohrc_folders = dict(known_ohrc)
+    for idx, ts in enumerate(ohr_ts, start=ohrc_start):
+        ohrc_folders[ts] = os.path.join(target_ohrc, f"ohr_{idx:03d}")
+    for ts, folder in ohrc_folders.items():
+        if ('ohr', ts) in found:
+            add(folder, *found[('ohr', ts)][0])
+        for source, member, target in found.get(('ohr_meta', ts), []):
+            add(folder, source, member, target)
+
+    return jobs, len(matched_ts), len(ohr_ts)
+
+
+def copy_members(source, members):
+    """Stream (member, dest) pairs out of one source; returns {member: sha256} of what was copied."""
+    zf = zipfile.ZipFile(source) if source.endswith(".zip") else None
+    digests = {}
+    try:
+        for member, dest in members:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            digest = hashlib.sha256()
+            with (zf.open(member) if zf is not None else open(member, "rb")) as src, open(dest, "wb") as dst:
+                while chunk := src.read(COPY_BUFFER):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            digests[member] = digest.hexdigest()
+    finally:
+        if zf is not None:
+            zf.close()
+    print(f"✅ Streamed {len(members)} files from {os.path.basename(source)}")
+    return digests
+
+
+def ingest(sources, target_ohrc, target_tmc, target_dtm, ohrc_start=0, pair_start=0, workers=INGEST_WORKERS):
+    """Scan every source's directory, then stream the needed members from several archives at once."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        scanned = dict(zip(sources, pool.map(scan_source, sources)))
+        jobs, pairs, ohrc = plan_copies(classify_entries(scanned), target_ohrc, target_tmc, target_dtm,
+                                        ohrc_start, pair_start)
+        for future in [pool.submit(copy_members, source, members) for source, members in jobs.items()]:
+            future.result()
+    return pairs, ohrc